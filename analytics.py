@@ -0,0 +1,50 @@
+from db import connect, ROLLUP_DIMS
+
+# ==========================================
+# 📈 評価の分析 (rating_rollup の集計済みの行だけを読む)
+# ==========================================
+# rating_rollup は history のトリガーで日別に更新される件数表。
+# 履歴本体は走査しないので、件数が増えても数百行の読み込みで済む。
+# 評価 0 は未評価 (閲覧のみ)。保存率・再作成率は生成件数に対する割合
+DIM_LABELS = {"style": "空間テイスト", "fabric": "張地", "frame": "フレーム", "floor": "床", "wall": "壁", "fitting": "建具"}
+
+
+def _summarize(rows):
+    # rows: (key, rating, action, count) → {key: 集計}
+    out = {}
+    for key, rating, action, n in rows:
+        s = out.setdefault(key, {"count": 0, "rated": 0, "rating_sum": 0, "dist": [0] * 5, "saved": 0, "retried": 0})
+        s["count"] += n
+        if rating:
+            s["rated"] += n
+            s["rating_sum"] += rating * n
+            s["dist"][rating - 1] += n
+        if action == "保存":
+            s["saved"] += n
+        elif action == "再作成":
+            s["retried"] += n
+    for s in out.values():
+        s["avg_rating"] = s["rating_sum"] / s["rated"] if s["rated"] else None
+        s["save_rate"] = s["saved"] / s["count"] if s["count"] else None
+        s["retry_rate"] = s["retried"] / s["count"] if s["count"] else None
+    return out
+
+
+def option_summary(dim, since=None):
+    # 選択肢ごとの件数・平均評価・評価分布・保存率・再作成率 (件数の多い順)。since は "YYYY-MM-DD"
+    if dim not in ROLLUP_DIMS:
+        raise ValueError(f"unknown dimension: {dim}")
+    with connect() as conn:
+        rows = conn.execute("""SELECT value, rating, action, SUM(count) FROM rating_rollup
+                               WHERE dim = ? AND day >= ? GROUP BY value, rating, action""", (dim, since or "")).fetchall()
+    summary = _summarize(rows)
+    return sorted(({"value": v or None, **s} for v, s in summary.items()), key=lambda r: -r["count"])
+
+
+def daily_summary(since=None):
+    # 日ごとの全体集計 (古い順)
+    with connect() as conn:
+        rows = conn.execute("""SELECT day, rating, action, SUM(count) FROM rating_rollup
+                               WHERE dim = 'all' AND day >= ? GROUP BY day, rating, action""", (since or "",)).fetchall()
+    summary = _summarize(rows)
+    return [{"day": d, **summary[d]} for d in sorted(summary)]
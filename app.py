@@ -1,56 +1,34 @@
 import streamlit as st
-import google.generativeai as genai
-from PIL import Image, ImageDraw, ImageFont
-import io
 import time
-import base64
-import sqlite3
 import os
+import uuid
+from datetime import datetime
+from db import init_db, save_to_db, query_history, count_history, history_changes
+from image_cache import rendition_bytes, artifact_bytes, ARTIFACT_FORMATS
+from gallery import Gallery
+from preprocess import prepare_image
+from recolor import quick_preview, PREVIEW_MAX_SIDE
+from texture import process_texture
+from generation import generate_record, snapshot_selection, variant_selections, is_rate_limited, GenerationFailed
+from jobs import get_job_queue, QueueFull
+from limiter import get_limiter
+from gemini_client import get_client, get_backend
+from metrics import metrics, stage_report
+from export import export_file, export_filename, EXPORT_FORMATS
+from analytics import option_summary, daily_summary, DIM_LABELS
+from retention import start_background as start_maintenance
 
 # --- ページ設定 ---
 st.set_page_config(page_title="Room AI Studio", layout="centered", initial_sidebar_state="collapsed")
 
-# ==========================================
-# 💾 データベース設定 (スマホ・PC間 同期用)
-# ==========================================
-DB_FILE = "room_ai_history.db"
-
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS history 
-                 (id TEXT PRIMARY KEY, timestamp REAL, base_img TEXT, gen_img TEXT, desc TEXT, rating INTEGER, action TEXT)''')
-    conn.commit()
-    conn.close()
-
-def save_to_db(data):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT id FROM history WHERE id=?", (data['id'],))
-    if c.fetchone():
-        c.execute("UPDATE history SET rating=?, action=? WHERE id=?", (data['rating'], data['action'], data['id']))
-    else:
-        c.execute("INSERT INTO history VALUES (?, ?, ?, ?, ?, ?, ?)", 
-                  (data['id'], data['timestamp'], data['base_img_b64'], data['gen_img_b64'], data['desc'], data['rating'], data['action']))
-    conn.commit()
-    conn.close()
-
-def load_from_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT * FROM history ORDER BY timestamp ASC")
-    rows = c.fetchall()
-    conn.close()
-    
-    history_list = []
-    for row in rows:
-        history_list.append({
-            'id': row[0], 'timestamp': row[1], 'base_img_b64': row[2], 
-            'gen_img_b64': row[3], 'desc': row[4], 'rating': row[5], 'action': row[6]
-        })
-    return history_list
-
 init_db()
+start_maintenance()
+metrics.start()
+
+ADMIN_PAGE_SIZE = 10
+ADMIN_LIVE_SIZE = 30  # ライブ表示に残す件数
+BATCH_MAX_VARIANTS = 12
+BATCH_MAX_CONCURRENCY = 6
 
 # ==========================================
 # 🎨 カラー・画像・初期設定データ
@@ -138,70 +116,41 @@ css += "</style>\n"
 st.markdown(css, unsafe_allow_html=True)
 
 # --- API設定 ---
+# SDK の読み込みとモデルの作成は gemini_client が初回だけ行う (再実行のたびには作らない)
 try:
     api_key = st.secrets["GEMINI_API_KEY"]
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('models/gemini-3-pro-image-preview')
+    backend = get_backend(api_key)
 except:
     st.error("API設定を確認してください。")
     st.stop()
 
-# --- 画像処理関数 ---
-def pil_to_b64(img):
-    buf = io.BytesIO()
-    img.save(buf, format="JPEG", quality=85)
-    return base64.b64encode(buf.getvalue()).decode("utf-8")
-
-def b64_to_pil(b64_str):
-    return Image.open(io.BytesIO(base64.b64decode(b64_str)))
-
-def crop_to_4_3_and_watermark(img):
-    w, h = img.size
-    target_ratio = 4 / 3
-    if w / h > target_ratio:
-        new_w = int(h * target_ratio)
-        img = img.crop(((w - new_w) / 2, 0, (w - new_w) / 2 + new_w, h))
-    else:
-        new_h = int(w / target_ratio)
-        img = img.crop((0, (h - new_h) / 2, w, (h - new_h) / 2 + new_h))
-    
-    # 1200x900にリサイズ
-    img = img.resize((1200, 900), Image.Resampling.LANCZOS)
-    
-    draw = ImageDraw.Draw(img)
-    # 透かしを3倍に
-    try: font = ImageFont.truetype("LiberationSans-Regular.ttf", int(img.height * 0.075)) 
-    except: font = ImageFont.load_default()
-    
-    bbox = draw.textbbox((0, 0), "HOTTA WOODWORKS-DX", font=font)
-    tw, th = bbox[2] - bbox[0], bbox[3] - bbox[1]
-    x, y = img.width - tw - 30, img.height - th - 30
-    
-    draw.text((x+2, y+2), "HOTTA WOODWORKS-DX", font=font, fill=(0,0,0,120))
-    draw.text((x, y), "HOTTA WOODWORKS-DX", font=font, fill=(255,255,255,240))
-    return img
-
 # --- セッション状態の初期化と自己治癒 ---
 if 'page' not in st.session_state: st.session_state.page = 'front'
-if 'gallery' not in st.session_state: st.session_state.gallery = [] 
+if 'gallery' not in st.session_state or isinstance(st.session_state.gallery, list): st.session_state.gallery = Gallery()
 if 'auto_gen' not in st.session_state: st.session_state.auto_gen = False
+if 'fresh_gen' not in st.session_state: st.session_state.fresh_gen = False
 if 'img_mode' not in st.session_state: st.session_state.img_mode = 'upload'
+if 'session_id' not in st.session_state: st.session_state.session_id = uuid.uuid4().hex
+if 'pending_jobs' not in st.session_state: st.session_state.pending_jobs = []
+if 'job_errors' not in st.session_state: st.session_state.job_errors = []
+if 'live_feed' not in st.session_state: st.session_state.live_feed = {"cursor": None, "logs": {}}
 
 # 【重要】古いキャッシュのNoneを修復して確実に辞書型にする
 for k in ['fabric', 'frame']:
     if k not in st.session_state or st.session_state[k] is None:
         st.session_state[k] = {"name": "変更なし", "val": "none", "type": "preset"}
         
-for k in ['style', 'floor', 'wall', 'fitting', 'up_fab', 'up_frame', 'cam_img']:
+for k in ['style', 'floor', 'wall', 'fitting', 'up_fab', 'up_frame', 'cam_img', 'preview']:
     if k not in st.session_state: 
         st.session_state[k] = None
 
 def go_to(page_name):
     st.session_state.page = page_name
-    st.session_state.gallery = []
+    st.session_state.gallery = Gallery()
+    st.session_state.pending_jobs = []
     for k in ['fabric', 'frame']:
         st.session_state[k] = {"name": "変更なし", "val": "none", "type": "preset"}
-    for k in ['style', 'floor', 'wall', 'fitting', 'up_fab', 'up_frame', 'cam_img']:
+    for k in ['style', 'floor', 'wall', 'fitting', 'up_fab', 'up_frame', 'cam_img', 'preview']:
         st.session_state[k] = None
     st.rerun()
 
@@ -244,6 +193,8 @@ def render_style_grid():
 
 def render_selected(label, selection, state_key):
     st.markdown(f"<div class='section-title'>{label}</div>", unsafe_allow_html=True)
+    # 独自画像はアップロード時に作った見本と主な色を表示する (texture.process_texture)
+    texture = st.session_state.get({"fabric": "up_fab", "frame": "up_frame"}[state_key]) if selection["type"] == "upload" else None
     c1, c2, c3 = st.columns([1, 3, 2])
     with c1:
         if selection["name"] == "変更なし":
@@ -252,10 +203,17 @@ def render_selected(label, selection, state_key):
             st.markdown(f'<div style="background-color:{selection["val"]}; width:100%; aspect-ratio:1/1; border-radius:8px; border:1px solid #e5e5ea;"></div>', unsafe_allow_html=True)
         elif selection["type"] == "style":
             st.markdown(f'<div style="background-image:url({selection["url"]}); background-size:cover; width:100%; aspect-ratio:1/1; border-radius:8px;"></div>', unsafe_allow_html=True)
+        elif texture:
+            st.image(texture["swatch"], use_container_width=True)
         else:
             st.markdown(f'<div style="background-color:#f5f5f7; width:100%; aspect-ratio:1/1; border-radius:8px; display:flex; align-items:center; justify-content:center; font-size:10px; color:#86868b; border:1px solid #e5e5ea;">画像</div>', unsafe_allow_html=True)
     with c2:
         st.markdown(f"<p style='font-size:14px; margin-top:8px;'>{selection['name']}</p>", unsafe_allow_html=True)
+        if texture:
+            # 素材写真の主な色 (多い順)
+            chips = "".join(f'<span title="{c} {share:.0%}" style="display:inline-block; width:18px; height:18px; margin-right:4px; border-radius:4px; border:1px solid #e5e5ea; background-color:{c};"></span>'
+                            for c, share in texture["palette"])
+            st.markdown(f"<div style='margin-top:-8px;'>{chips}</div>", unsafe_allow_html=True)
     with c3:
         if st.button("変更", key=f"chg_{state_key}"):
             if state_key in ['fabric', 'frame']:
@@ -266,6 +224,169 @@ def render_selected(label, selection, state_key):
                 elif state_key == "wall": st.session_state.fitting = None
             st.rerun()
 
+def selection_color(selection, texture):
+    # 簡易プレビューで塗る色。変更なしは None、独自画像はその最も多い色
+    if selection["name"] == "変更なし": return None
+    if selection["type"] == "upload": return texture["palette"][0][0] if texture and texture["palette"] else None
+    return selection["val"]
+
+def render_color_trial(f_file):
+    # 写真の色を置き換えるだけの簡易プレビュー (AI を使わないので選ぶたびにすぐ表示される)
+    fab_groups = {"布": COLORS_FABRIC, "革": COLORS_LEATHER}
+    frm_groups = {"木材": COLORS_WOOD, "金属": COLORS_METAL}
+    fab_opts = [None] + [(g, n) for g, d in fab_groups.items() for n in d]
+    frm_opts = [None] + [(g, n) for g, d in frm_groups.items() for n in d]
+    label = lambda o: "変更なし" if o is None else f"{o[0]} / {o[1]}"
+    c1, c2 = st.columns(2)
+    with c1: t_fab = st.selectbox("張地", fab_opts, format_func=label, key="try_fab")
+    with c2: t_frm = st.selectbox("フレーム", frm_opts, format_func=label, key="try_frm")
+    fab_hex = fab_groups[t_fab[0]][t_fab[1]] if t_fab else None
+    frm_hex = frm_groups[t_frm[0]][t_frm[1]] if t_frm else None
+    st.image(quick_preview(prepare_image(f_file.getvalue(), PREVIEW_MAX_SIDE), fab_hex, frm_hex), use_container_width=True)
+    st.caption("写真の色を置き換えただけの目安です。素材感や仕上がりは生成結果で確認してください。")
+    if st.button("この組み合わせで設定", key="try_apply", use_container_width=True):
+        st.session_state.fabric = {"name": t_fab[1], "val": fab_hex, "type": "preset"} if t_fab else {"name": "変更なし", "val": "none", "type": "preset"}
+        st.session_state.frame = {"name": t_frm[1], "val": frm_hex, "type": "preset"} if t_frm else {"name": "変更なし", "val": "none", "type": "preset"}
+        st.rerun()
+
+@st.fragment(run_every=1.0)
+def render_job_status():
+    queue = get_job_queue()
+    finished = False
+    active = []
+    for job_id in list(st.session_state.pending_jobs):
+        job = queue.get(job_id)
+        if job is None or job.status in ("done", "failed"):
+            st.session_state.pending_jobs.remove(job_id)
+            finished = True
+            if job is None:
+                continue
+            if job.status == "done":
+                st.session_state.gallery.append(job.result)
+            elif isinstance(job.error, GenerationFailed):
+                st.session_state.job_errors.append(str(job.error))
+            elif is_rate_limited(job.error):
+                st.session_state.job_errors.append("ただいま混み合っているため生成できませんでした。少し時間をおいて再作成してください。")
+            else:
+                st.session_state.job_errors.append(f"エラー: {job.error}")
+        else:
+            active.append(job)
+    if finished:
+        st.rerun(scope="app")
+
+    # 完了までの目安は、待ち行列の位置・実行時間の実績・API の上限から見積もる
+    rate = get_limiter().rate
+    eta = max((queue.estimate_wait(j.id, rate) or 0 for j in active), default=0)
+    eta_s = f"完了まで 約 {int(eta // 60)} 分 {int(eta % 60)} 秒" if eta >= 60 else f"完了まで 約 {int(eta)} 秒"
+    if len(active) == 1:
+        job = active[0]
+        if job.status == "queued":
+            st.info(f"⏳ 順番待ち: {queue.position(job.id)} 番目 ({eta_s})")
+        else:
+            st.info(f"🎨 AIで画像を生成しています... ({int(time.time() - job.submitted_at)}秒 / {eta_s})")
+    elif active:
+        running = sum(1 for j in active if j.status == "running")
+        st.info(f"🎨 {len(active)} 件を生成しています... (生成中 {running} 件 / 順番待ち {len(active) - running} 件 / {eta_s})")
+    if active and get_limiter().status()["paused"]:
+        st.caption("混み合っているため、順番に少しずつ処理しています。このままお待ちください。")
+
+def render_stage_metrics():
+    hours = st.selectbox("集計期間", [1, 24, 24 * 7], index=1, format_func=lambda h: f"直近 {h} 時間" if h < 48 else f"直近 {h // 24} 日")
+    since = time.time() - hours * 3600
+    metrics.try_flush()
+
+    summary = stage_report(since, period=None)
+    if not summary:
+        st.markdown("<p style='color: #86868b;'>計測データはまだありません。</p>", unsafe_allow_html=True)
+        return
+    ms = lambda v: None if v is None else round(v * 1000, 1)
+    st.dataframe([{"ステージ": r["stage"], "件数": r["count"], "エラー": r["errors"], "平均 ms": ms(r["mean"]),
+                   "p50 ms": ms(r["p50"]), "p95 ms": ms(r["p95"]), "p99 ms": ms(r["p99"])} for r in summary],
+                 hide_index=True, use_container_width=True)
+
+    # p95 の推移 (1時間表示は1分単位、それ以外は1時間単位)
+    rows = stage_report(since, period=60 if hours == 1 else 3600)
+    periods = sorted({r["period"] for r in rows})
+    stages = sorted({r["stage"] for r in rows})
+    p95 = {(r["period"], r["stage"]): ms(r["p95"]) for r in rows}
+    chart = {"時刻": [datetime.fromtimestamp(p) for p in periods]}
+    for s in stages:
+        chart[s] = [p95.get((p, s)) for p in periods]
+    st.markdown("<p style='font-size:12px; color:#86868b; margin-bottom:4px;'>p95 (ms) の推移</p>", unsafe_allow_html=True)
+    st.line_chart(chart, x="時刻", y=stages)
+
+def render_thumb(log, role):
+    data = rendition_bytes(log["id"], role, "thumb")
+    if data is None:
+        # 保持期間を過ぎて画像をアーカイブに移したレコード
+        st.markdown(f"<p style='font-size:12px; color:#86868b;'>アーカイブ済み ({log['archive'] or '画像なし'})</p>", unsafe_allow_html=True)
+    else:
+        st.image(data, use_container_width=True)
+
+def render_log_card(log):
+    st.markdown("<div style='padding: 24px; background-color: #ffffff; border: 1px solid #e5e5ea; border-radius: 16px; margin-bottom: 24px;'>", unsafe_allow_html=True)
+
+    img_col1, img_col2 = st.columns(2)
+    with img_col1:
+        st.markdown("<p style='font-size:12px; color:#86868b; margin-bottom:4px;'>ベース画像</p>", unsafe_allow_html=True)
+        render_thumb(log, "base")
+    with img_col2:
+        st.markdown("<p style='font-size:12px; color:#86868b; margin-bottom:4px;'>生成結果</p>", unsafe_allow_html=True)
+        render_thumb(log, "gen")
+
+    st.write("")
+    st.markdown(f"<span style='font-weight:600;'>設定詳細:</span> {log['desc']}", unsafe_allow_html=True)
+    st.markdown(f"<span style='font-weight:600;'>評価:</span> {log['rating']} / 5", unsafe_allow_html=True)
+    st.markdown(f"<span style='font-weight:600;'>アクション:</span> {log['action']}", unsafe_allow_html=True)
+
+    st.markdown("</div>", unsafe_allow_html=True)
+
+def render_live_feed():
+    # 前回以降に追加・評価された行だけを DB から読み、表示済みの行はセッションに残して使い回す
+    # (サムネイルは image_cache のキャッシュから出るので、読み込みと展開は新しい行の分だけ)
+    feed = st.session_state.live_feed
+    changed, feed["cursor"] = history_changes(feed["cursor"], ADMIN_LIVE_SIZE)
+    for log in changed:
+        feed["logs"].pop(log["id"], None)
+        feed["logs"][log["id"]] = log
+    for record_id in list(feed["logs"])[:-ADMIN_LIVE_SIZE]:
+        del feed["logs"][record_id]
+    if not feed["logs"]:
+        st.markdown("<p style='color: #86868b;'>保存されたデータはありません。</p>", unsafe_allow_html=True)
+        return
+    st.caption(f"{datetime.now():%H:%M:%S} 更新 (新着・更新 {len(changed)} 件)。直近に追加・評価された {len(feed['logs'])} 件を新しい順に表示")
+    for log in reversed(list(feed["logs"].values())):
+        render_log_card(log)
+
+def render_rating_analytics():
+    c1, c2 = st.columns(2)
+    with c1:
+        dim = st.selectbox("項目", list(DIM_LABELS), format_func=DIM_LABELS.get)
+    with c2:
+        days = st.selectbox("集計期間", [7, 30, 90, None], index=1, key="analytics_days", format_func=lambda d: f"直近 {d} 日" if d else "全期間")
+    since = datetime.fromtimestamp(time.time() - (days - 1) * 86400).strftime("%Y-%m-%d") if days else None
+
+    daily = daily_summary(since)
+    if not daily:
+        st.markdown("<p style='color: #86868b;'>集計データはまだありません。</p>", unsafe_allow_html=True)
+        return
+    pct = lambda v: None if v is None else round(v * 100, 1)
+    avg = lambda v: None if v is None else round(v, 2)
+    st.dataframe([{DIM_LABELS[dim]: r["value"] or "(未選択)", "件数": r["count"], "評価済み": r["rated"], "平均評価": avg(r["avg_rating"]),
+                   **{f"★{i + 1}": c for i, c in enumerate(r["dist"])},
+                   "保存率 %": pct(r["save_rate"]), "再作成率 %": pct(r["retry_rate"])} for r in option_summary(dim, since)],
+                 hide_index=True, use_container_width=True)
+
+    st.markdown("<p style='font-size:12px; color:#86868b; margin-bottom:4px;'>日別の平均評価と保存率・再作成率</p>", unsafe_allow_html=True)
+    st.line_chart({"日付": [datetime.strptime(r["day"], "%Y-%m-%d") for r in daily],
+                   "平均評価": [avg(r["avg_rating"]) for r in daily],
+                   "保存率 %": [pct(r["save_rate"]) for r in daily],
+                   "再作成率 %": [pct(r["retry_rate"]) for r in daily]},
+                  x="日付", y=["平均評価", "保存率 %", "再作成率 %"])
+    dist = [sum(r["dist"][i] for r in daily) for i in range(5)]
+    st.markdown("<p style='font-size:12px; color:#86868b; margin-bottom:4px;'>評価の分布</p>", unsafe_allow_html=True)
+    st.bar_chart({"評価": [f"★{i + 1}" for i in range(5)], "件数": dist}, x="評価", y="件数")
+
 # ==========================================
 # 🏠 1. フロントページ
 # ==========================================
@@ -289,6 +410,7 @@ if st.session_state.page == 'front':
 # 🛋️ 2. ソファ・コーディネート画面
 # ==========================================
 elif st.session_state.page == 'sofa':
+    get_client(api_key).warm()
     st.markdown("<h2>家具の設定</h2>", unsafe_allow_html=True)
     st.markdown("<div class='helper-text'>ベースとなる家具の写真をアップロードし、各素材や空間のテイストを選択してください。</div>", unsafe_allow_html=True)
     
@@ -311,7 +433,10 @@ elif st.session_state.page == 'sofa':
         up_res = st.file_uploader("ベース画像", type=["jpg", "png", "jpeg"], label_visibility="collapsed")
         if up_res: f_file = up_res
         
-    if f_file: st.image(f_file, width=200)
+    if f_file:
+        st.image(f_file, width=200)
+        if st.toggle("色を試す (簡易プレビュー)", key="try_colors"):
+            render_color_trial(f_file)
     
     st.divider()
 
@@ -324,8 +449,9 @@ elif st.session_state.page == 'sofa':
         st.write("")
         up_fab = st.file_uploader("独自の画像をアップロード (張地)", type=["jpg", "png"], key="ufab", label_visibility="collapsed")
         if up_fab:
-            st.session_state.fabric = {"name": "独自画像", "val": up_fab, "type": "upload"}
-            st.session_state.up_fab = pil_to_b64(Image.open(up_fab))
+            # 代表部分の切り出し・主な色・見本をここで一度だけ作る (ファイル本体はセッションに残さない)
+            st.session_state.up_fab = process_texture(up_fab.getvalue())
+            st.session_state.fabric = {"name": "独自画像", "val": st.session_state.up_fab["hash"], "type": "upload"}
             st.rerun()
     else:
         render_selected("張地", st.session_state.fabric, "fabric")
@@ -340,8 +466,8 @@ elif st.session_state.page == 'sofa':
         st.write("")
         up_frm = st.file_uploader("独自の画像をアップロード (フレーム)", type=["jpg", "png"], key="ufrm", label_visibility="collapsed")
         if up_frm:
-            st.session_state.frame = {"name": "独自画像", "val": up_frm, "type": "upload"}
-            st.session_state.up_frame = pil_to_b64(Image.open(up_frm))
+            st.session_state.up_frame = process_texture(up_frm.getvalue())
+            st.session_state.frame = {"name": "独自画像", "val": st.session_state.up_frame["hash"], "type": "upload"}
             st.rerun()
     else:
         render_selected("フレーム", st.session_state.frame, "frame")
@@ -387,65 +513,66 @@ elif st.session_state.page == 'sofa':
         if st.button("設定をリセット", use_container_width=True): go_to('sofa')
 
     if gen_clicked or st.session_state.auto_gen:
-        st.session_state.auto_gen = False
+        # 再作成のときは生成結果のキャッシュを使わない (別の結果を出すため)
+        fresh = st.session_state.fresh_gen
+        st.session_state.auto_gen = st.session_state.fresh_gen = False
         if not f_file:
             st.error("ベース画像を用意してください。")
         else:
-            with st.spinner("AIで画像を生成しています..."):
-                try:
-                    main_img = Image.open(f_file)
-                    
-                    # プロンプトの組み立て
-                    fab_p = "" if st.session_state.fabric["name"] == "変更なし" else f"Upholstery: {st.session_state.fabric['name']}."
-                    frame_p = "" if st.session_state.frame["name"] == "変更なし" else f"Frame/Legs: {st.session_state.frame['name']}."
-                    style_p = st.session_state.style["name"] if st.session_state.style else "modern"
-                    floor_p = st.session_state.floor["name"] if st.session_state.floor else "matching"
-                    wall_p = st.session_state.wall["name"] if st.session_state.wall else "matching"
-                    fitting_p = st.session_state.fitting["name"] if st.session_state.fitting else "matching"
-                    
-                    prompt = f"""
-                    GENERATE_IMAGE: Create a highly realistic interior design photo.
-                    Furniture: The sofa from the first attached image. Maintain exact shape.
-                    {fab_p} {frame_p}
-                    Style: {style_p} interior.
-                    Interior: Floor: {floor_p}, Walls: {wall_p}, Doors/Fittings: {fitting_p}.
-                    """
-                    
-                    inputs = [prompt, main_img]
-                    if st.session_state.up_fab: inputs.append(b64_to_pil(st.session_state.up_fab))
-                    if st.session_state.up_frame: inputs.append(b64_to_pil(st.session_state.up_frame))
-                    
-                    response = model.generate_content(inputs)
-                    
-                    gen_img = None
-                    if response.candidates:
-                        for part in response.candidates[0].content.parts:
-                            if hasattr(part, 'inline_data'):
-                                gen_img = Image.open(io.BytesIO(part.inline_data.data))
-                                break
-                            elif 'image' in str(type(part)):
-                                gen_img = part
-                                
-                    if gen_img:
-                        final_img = crop_to_4_3_and_watermark(gen_img)
-                        desc_str = f"{style_p} / "
-                        desc_str += f"張地:{st.session_state.fabric['name']} / "
-                        desc_str += f"フレーム:{st.session_state.frame['name']}"
-                        
-                        new_log = {
-                            "id": str(time.time()),
-                            "timestamp": time.time(),
-                            "base_img_b64": pil_to_b64(main_img.copy()), 
-                            "gen_img_b64": pil_to_b64(final_img),
-                            "desc": desc_str,
-                            "rating": 0, "action": "閲覧のみ"
-                        }
-                        st.session_state.gallery.append(new_log)
-                        save_to_db(new_log)
-                    else:
-                        st.error("生成に失敗しました。")
-                except Exception as e:
-                    st.error(f"エラー: {e}")
+            textures = [t["tile"] for t in (st.session_state.up_fab, st.session_state.up_frame) if t]
+            try:
+                job_id = get_job_queue().submit(generate_record, backend, f_file.getvalue(), textures,
+                                                snapshot_selection(st.session_state), fresh, session_id=st.session_state.session_id)
+                st.session_state.pending_jobs.append(job_id)
+                # 生成を待つ間に表示する、色だけを置き換えたプレビュー
+                st.session_state.preview = quick_preview(prepare_image(f_file.getvalue(), PREVIEW_MAX_SIDE),
+                                                         selection_color(st.session_state.fabric, st.session_state.up_fab),
+                                                         selection_color(st.session_state.frame, st.session_state.up_frame))
+            except QueueFull as e:
+                st.warning(str(e))
+
+    # --- まとめて生成 (色違い・テイスト違いを並列で) ---
+    with st.expander("まとめて生成 (色違いを一度に作成)"):
+        fab_opts = [("布", n) for n in COLORS_FABRIC] + [("革", n) for n in COLORS_LEATHER]
+        frm_opts = [("木材", n) for n in COLORS_WOOD] + [("金属", n) for n in COLORS_METAL]
+        b_fabs = st.multiselect("張地", fab_opts, format_func=lambda o: f"{o[0]} / {o[1]}", placeholder="現在の選択のまま")
+        b_frms = st.multiselect("フレーム", frm_opts, format_func=lambda o: f"{o[0]} / {o[1]}", placeholder="現在の選択のまま")
+        b_stys = st.multiselect("空間テイスト", list(STYLES), placeholder="現在の選択のまま")
+        b_conc = st.slider("同時に生成する数", 1, BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY)
+        variants = variant_selections(snapshot_selection(st.session_state), [n for _, n in b_fabs],
+                                      [n for _, n in b_frms], b_stys, STYLE_DEFAULTS)
+        if len(variants) > BATCH_MAX_VARIANTS:
+            st.warning(f"組み合わせは最大 {BATCH_MAX_VARIANTS} 件までです (現在 {len(variants)} 件)。")
+        elif st.button(f"{len(variants)} 件をまとめて生成", use_container_width=True, disabled=len(variants) < 2):
+            if not f_file:
+                st.error("ベース画像を用意してください。")
+            else:
+                base_bytes = f_file.getvalue()
+                batch_id = uuid.uuid4().hex
+                st.session_state.preview = None
+                for n, v in enumerate(variants):
+                    # 独自画像は、その張地/フレームを使う組み合わせにだけ添付する
+                    textures = [t["tile"] for t, k in ((st.session_state.up_fab, "fabric"), (st.session_state.up_frame, "frame"))
+                                if t and v[k] == "独自画像"]
+                    try:
+                        job_id = get_job_queue().submit(generate_record, backend, base_bytes, textures, v,
+                                                        session_id=st.session_state.session_id, group=batch_id, group_limit=b_conc)
+                    except QueueFull as e:
+                        st.warning(f"{e} ({n} / {len(variants)} 件を受け付けました)")
+                        break
+                    st.session_state.pending_jobs.append(job_id)
+
+    # --- 生成ジョブの進捗 (完了したらギャラリーに追加) ---
+    for msg in st.session_state.job_errors:
+        st.error(msg)
+    st.session_state.job_errors = []
+    if st.session_state.pending_jobs:
+        if st.session_state.preview:
+            st.image(st.session_state.preview, use_container_width=True)
+            st.caption("プレビュー (色の目安)。AI の生成が終わると結果に置き換わります。")
+        render_job_status()
+    else:
+        st.session_state.preview = None
 
     # --- ギャラリー・評価 ---
     if st.session_state.gallery:
@@ -455,13 +582,21 @@ elif st.session_state.page == 'sofa':
         total = len(st.session_state.gallery)
         idx = 0
         if total > 1:
+            # 直近の記録はセッション内のサムネイルで一覧表示
+            recent = [(i, e) for i, e in st.session_state.gallery.recent() if e["thumb"]]
+            st.image([e["thumb"] for _, e in recent], width=72, caption=[f"{i + 1}" for i, _ in recent])
             idx = st.slider("スワイプして履歴を確認", 1, total, total) - 1
             
         res = st.session_state.gallery[idx]
-        display_img = b64_to_pil(res["gen_img_b64"])
-        
-        # 画面幅いっぱいに表示
-        st.image(display_img, use_container_width=True)
+        if res is None:
+            # 削除済みの記録はギャラリーから外れたので、件数を数え直して表示し直す
+            st.rerun()
+        # 画面幅いっぱいに表示 (プレビュー版で十分)。画像をアーカイブに移した記録は表示できない
+        preview = rendition_bytes(res["id"], "gen", "preview")
+        if preview is None:
+            st.markdown(f"<p style='font-size:12px; color:#86868b;'>画像はアーカイブ済みです ({res.get('archive') or '画像なし'})</p>", unsafe_allow_html=True)
+        else:
+            st.image(preview, use_container_width=True)
         st.caption(res["desc"])
         
         st.write("")
@@ -472,11 +607,14 @@ elif st.session_state.page == 'sofa':
         if rating is not None:
             res["rating"] = rating
             st.write("")
+            dl_fmt = st.radio("保存形式", list(ARTIFACT_FORMATS), horizontal=True, key="dl_format",
+                              format_func={"png": "PNG", "jpeg": "JPEG (軽量)", "webp": "WebP (軽量)"}.get)
+            mime, ext, _ = ARTIFACT_FORMATS[dl_fmt]
             col_a, col_b = st.columns(2)
             with col_a:
-                buf = io.BytesIO()
-                display_img.save(buf, format="PNG")
-                if st.download_button("保存", data=buf.getvalue(), file_name=f"room_ai_{int(time.time())}.png", mime="image/png", use_container_width=True):
+                # 原寸画像に触るのはダウンロードだけ。変換はボタンを押したときに一度だけ行い、結果はキャッシュする
+                if st.download_button("保存", data=lambda res=res, fmt=dl_fmt: artifact_bytes(res, fmt),
+                                      file_name=f"room_ai_{int(res['timestamp'])}.{ext}", mime=mime, use_container_width=True):
                     res["action"] = "保存"
                     save_to_db(res)
                     st.success("保存完了")
@@ -484,7 +622,7 @@ elif st.session_state.page == 'sofa':
                 if st.button("再作成", use_container_width=True, key=f"retry_{res['id']}"):
                     res["action"] = "再作成"
                     save_to_db(res)
-                    st.session_state.auto_gen = True
+                    st.session_state.auto_gen = st.session_state.fresh_gen = True
                     st.rerun()
 
     st.divider()
@@ -500,32 +638,73 @@ elif st.session_state.page == 'admin':
     if pw == "hotta-admin":
         st.write("")
         if st.button("🔄 最新のデータを読み込む", use_container_width=True):
+            st.session_state.admin_cursors = [None]
             st.rerun()
-            
-        history_data = load_from_db()
-        
-        if not history_data:
-            st.markdown("<p style='color: #86868b;'>保存されたデータはありません。</p>", unsafe_allow_html=True)
+
+        # --- 処理時間 (ステージ別) ---
+        if st.toggle("処理時間を表示 (ステージ別 p50 / p95 / p99)"):
+            render_stage_metrics()
+        # --- 評価の分析 (集計テーブルから) ---
+        if st.toggle("評価の分析を表示 (選択肢別・日別)"):
+            render_rating_analytics()
+        st.write("")
+
+        # --- ライブ表示 (前回以降に追加・評価されたものだけを読み込む) ---
+        if st.toggle("ライブ表示 (新しい記録・評価を随時表示)", key="admin_live"):
+            every = st.selectbox("自動更新", [None, 5, 15, 60], index=2, key="admin_live_every",
+                                 format_func=lambda s: "しない (上のボタンで更新)" if s is None else f"{s} 秒ごと")
+            if every:
+                st.fragment(run_every=every)(render_live_feed)()
+            else:
+                render_live_feed()
         else:
-            st.write(f"記録数: {len(history_data)}件")
-            for log in reversed(history_data):
-                if log['rating'] > 0:
-                    st.markdown("<div style='padding: 24px; background-color: #ffffff; border: 1px solid #e5e5ea; border-radius: 16px; margin-bottom: 24px;'>", unsafe_allow_html=True)
-                    
-                    img_col1, img_col2 = st.columns(2)
-                    with img_col1:
-                        st.markdown("<p style='font-size:12px; color:#86868b; margin-bottom:4px;'>ベース画像</p>", unsafe_allow_html=True)
-                        st.image(b64_to_pil(log["base_img_b64"]), use_container_width=True)
-                    with img_col2:
-                        st.markdown("<p style='font-size:12px; color:#86868b; margin-bottom:4px;'>生成結果</p>", unsafe_allow_html=True)
-                        st.image(b64_to_pil(log["gen_img_b64"]), use_container_width=True)
-                    
-                    st.write("")
-                    st.markdown(f"<span style='font-weight:600;'>設定詳細:</span> {log['desc']}", unsafe_allow_html=True)
-                    st.markdown(f"<span style='font-weight:600;'>評価:</span> {log['rating']} / 5", unsafe_allow_html=True)
-                    st.markdown(f"<span style='font-weight:600;'>アクション:</span> {log['action']}", unsafe_allow_html=True)
-                    
-                    st.markdown("</div>", unsafe_allow_html=True)
+            # --- 絞り込み (SQL側で実行) ---
+            f1, f2, f3 = st.columns(3)
+            with f1:
+                min_rating = st.selectbox("評価", [1, 2, 3, 4, 5], format_func=lambda r: f"{r} 以上")
+            with f2:
+                action = st.selectbox("アクション", ["すべて", "閲覧のみ", "保存", "再作成"])
+            with f3:
+                period = st.date_input("期間", value=(), format="YYYY/MM/DD")
+            filters = {"min_rating": min_rating, "action": None if action == "すべて" else action}
+            if len(period) == 2:
+                filters["since"] = time.mktime(period[0].timetuple())
+                filters["until"] = time.mktime(period[1].timetuple()) + 86400
+
+            # 絞り込み条件が変わったら1ページ目に戻す
+            if st.session_state.get("admin_filters") != filters:
+                st.session_state.admin_filters = filters
+                st.session_state.admin_cursors = [None]
+            cursors = st.session_state.admin_cursors
+
+            total = count_history(**filters)
+            history_page, next_cursor = query_history(ADMIN_PAGE_SIZE, cursors[-1], **filters)
+
+            # --- 一括エクスポート (上の絞り込み条件で、ボタンを押したときだけ作成) ---
+            with st.expander(f"一括エクスポート ({total}件)"):
+                fmt = st.radio("形式", list(EXPORT_FORMATS), horizontal=True,
+                               format_func={"zip": "ZIP (画像 + マニフェスト)", "ndjson": "NDJSON", "csv": "CSV"}.get)
+                st.download_button("ダウンロード", data=lambda fmt=fmt, filters=dict(filters): export_file(fmt, **filters),
+                                   file_name=export_filename(fmt), mime=EXPORT_FORMATS[fmt],
+                                   use_container_width=True, disabled=not total, on_click="ignore")
+
+            if not history_page:
+                st.markdown("<p style='color: #86868b;'>保存されたデータはありません。</p>", unsafe_allow_html=True)
+            else:
+                page_no = len(cursors)
+                st.write(f"記録数: {total}件 ({page_no} / {max(1, -(-total // ADMIN_PAGE_SIZE))} ページ)")
+                for log in history_page:
+                    render_log_card(log)
+
+                p1, p2 = st.columns(2)
+                with p1:
+                    if page_no > 1 and st.button("← 前のページ", use_container_width=True):
+                        cursors.pop()
+                        st.rerun()
+                with p2:
+                    if next_cursor and st.button("次のページ →", use_container_width=True):
+                        cursors.append(next_cursor)
+                        st.rerun()
     elif pw:
         st.error("パスワードが違います。")
         
@@ -0,0 +1,158 @@
+from PIL import Image, ImageOps
+import hashlib
+import io
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# ==========================================
+# 🔌 画像生成バックエンド
+# ==========================================
+# generation.generate_record はバックエンドの generate(inputs) だけを呼ぶ。
+# inputs は [プロンプト, 画像part, ...]、戻り値は生成画像 (PIL) か None。
+# 本番は GeminiBackend、ベンチマーク・負荷試験はネットワーク不要の FakeBackend を使う。
+# HedgedBackend / limiter.LimitedBackend は他のバックエンドを包んで使う。
+HEDGE_QUANTILE = 0.95
+HEDGE_MIN_SAMPLES = 20  # これだけ実績が溜まるまでは予備リクエストを送らない
+HEDGE_WINDOW = 200
+
+
+class GeminiBackend:
+    name = "gemini"
+
+    def __init__(self, client):
+        # client: gemini_client.GeminiClient (generate_content(inputs) を持つもの)
+        self.client = client
+
+    def generate(self, inputs):
+        return extract_image(self.client.generate_content(inputs))
+
+
+def extract_image(response):
+    gen_img = None
+    if response.candidates:
+        for part in response.candidates[0].content.parts:
+            if hasattr(part, 'inline_data'):
+                return Image.open(io.BytesIO(part.inline_data.data))
+            elif 'image' in str(type(part)):
+                gen_img = part
+    return gen_img
+
+
+class HedgedBackend:
+    # 呼び出しが直近の応答時間の quantile を過ぎても返らないとき、同じ入力で2本目を送り、
+    # 先に画像を返した方を使う。遅れた方は止められないので、結果を捨てるだけ。
+    # allow() が False のとき (混雑時など) は2本目を送らない
+    _executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
+
+    def __init__(self, backend, quantile=HEDGE_QUANTILE, allow=None):
+        self.backend = backend
+        self.name = backend.name
+        self.quantile = quantile
+        self.allow = allow
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=HEDGE_WINDOW)
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def _timed(self, inputs):
+        t = time.perf_counter()
+        result = self.backend.generate(inputs)
+        with self._lock:
+            self._latencies.append(time.perf_counter() - t)
+        return result
+
+    def hedge_delay(self):
+        with self._lock:
+            if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(self.quantile * len(latencies)))]
+
+    def generate(self, inputs):
+        delay = self.hedge_delay()
+        if delay is None:
+            return self._timed(inputs)
+        first = self._executor.submit(self._timed, inputs)
+        done, _ = wait([first], timeout=delay)
+        if done or (self.allow and not self.allow()):
+            return first.result()
+        second = self._executor.submit(self._timed, inputs)
+        with self._lock:
+            self.hedged += 1
+        pending, error = {first, second}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                if f.exception() is None and f.result() is not None:
+                    if f is second:
+                        with self._lock:
+                            self.hedge_wins += 1
+                    return f.result()
+                error = error or f.exception()
+        if error:
+            raise error
+        return None
+
+
+class FakeRateLimitError(Exception):
+    code = 429
+
+
+class FakeBackend:
+    # 決まった遅延・失敗率で、入力から決まる画像 (PNG) を返すローカルの代用品。
+    # 同じ seed なら遅延・失敗の並びも同じになる。quota_rpm を指定すると、
+    # 直近60秒の呼び出しがその回数を超えたときに 429 を返す (本物の割り当て超過の再現)。
+    # slow_rate の割合の呼び出しは遅延が slow_factor 倍になる (応答時間の裾の再現)
+    name = "fake"
+
+    def __init__(self, latency=8.0, jitter=2.0, failure_rate=0.0, rate_limit_rate=0.0, size=(1024, 1024), seed=0,
+                 quota_rpm=None, slow_rate=0.0, slow_factor=5.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.size = size
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._png = {}
+        self.calls = 0
+        self.quota_rpm = quota_rpm
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self._recent = deque()
+
+    def generate(self, inputs):
+        with self._lock:
+            self.calls += 1
+            delay = max(0.0, self._rng.gauss(self.latency, self.jitter))
+            if self.slow_rate and self._rng.random() < self.slow_rate:
+                delay *= self.slow_factor
+            roll = self._rng.random()
+            if self.quota_rpm:
+                now = time.monotonic()
+                while self._recent and now - self._recent[0] > 60:
+                    self._recent.popleft()
+                self._recent.append(now)
+                if len(self._recent) > self.quota_rpm:
+                    raise FakeRateLimitError("429 Resource has been exhausted (e.g. check quota).")
+        time.sleep(delay)
+        if roll < self.rate_limit_rate:
+            raise FakeRateLimitError("429 Resource has been exhausted (e.g. check quota).")
+        if roll < self.rate_limit_rate + self.failure_rate:
+            return None
+        # 本物と同じく、毎回 PNG をデコードして返す
+        return Image.open(io.BytesIO(self._render(str(inputs[0]))))
+
+    def _render(self, prompt):
+        key = hashlib.sha256(prompt.encode()).digest()
+        with self._lock:
+            if key not in self._png:
+                grad = Image.linear_gradient("L").resize(self.size)
+                img = ImageOps.colorize(grad, (key[0] // 4, key[1] // 4, key[2] // 4), (key[3], key[4], key[5]))
+                buf = io.BytesIO()
+                img.save(buf, format="PNG")
+                self._png[key] = buf.getvalue()
+            return self._png[key]
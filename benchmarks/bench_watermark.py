@@ -0,0 +1,93 @@
+from PIL import Image, ImageChops, ImageDraw, ImageFont, ImageStat
+import argparse
+import math
+import sys
+import time
+from imaging import WatermarkRenderer
+
+# ==========================================
+# ⏱️ 透かし処理のマイクロベンチマーク
+# ==========================================
+# 実行: python -m benchmarks.bench_watermark
+# 旧実装 (毎回フォント読み込み・文字の配置・2回描画・LANCZOS だけで縮小) と WatermarkRenderer を
+# 生成 API が返しうる入力サイズごとに比較する。出力の2倍以上の入力は reduce() を通るので、
+# 画質は旧実装の出力との PSNR と最大差で確かめる (MIN_PSNR dB 未満なら終了コード 1)。
+SIZES = [(1024, 1024), (1536, 1152), (2048, 2048), (2400, 1800), (4096, 3072), (6000, 4000)]
+# 画素ごとのノイズ (sample_image) は reduce() の平均に最も不利な入力で、ここで 34〜37 dB。
+# 少しぼかした写真に近い入力では 40 dB 以上になる。30 dB を下回ったら見た目でも分かる劣化とみなす
+MIN_PSNR = 30.0
+
+
+def legacy_crop_to_4_3_and_watermark(img):
+    w, h = img.size
+    target_ratio = 4 / 3
+    if w / h > target_ratio:
+        new_w = int(h * target_ratio)
+        img = img.crop(((w - new_w) / 2, 0, (w - new_w) / 2 + new_w, h))
+    else:
+        new_h = int(w / target_ratio)
+        img = img.crop((0, (h - new_h) / 2, w, (h - new_h) / 2 + new_h))
+
+    img = img.resize((1200, 900), Image.Resampling.LANCZOS)
+
+    draw = ImageDraw.Draw(img)
+    try: font = ImageFont.truetype("LiberationSans-Regular.ttf", int(img.height * 0.075))
+    except: font = ImageFont.load_default()
+
+    bbox = draw.textbbox((0, 0), "HOTTA WOODWORKS-DX", font=font)
+    tw, th = bbox[2] - bbox[0], bbox[3] - bbox[1]
+    x, y = img.width - tw - 30, img.height - th - 30
+
+    draw.text((x+2, y+2), "HOTTA WOODWORKS-DX", font=font, fill=(0,0,0,120))
+    draw.text((x, y), "HOTTA WOODWORKS-DX", font=font, fill=(255,255,255,240))
+    return img
+
+
+def sample_image(size):
+    # 単色だと縮小が速すぎるので、グラデーションとノイズで写真に近づける
+    grad = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 40)
+    return Image.merge("RGB", (grad, noise, grad.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+
+
+def compare(a, b):
+    # (PSNR dB, 最大差)。一致していれば PSNR は inf
+    diff = ImageChops.difference(a.convert("RGB"), b.convert("RGB"))
+    stat = ImageStat.Stat(diff)
+    mse = sum(stat.sum2) / (diff.width * diff.height * len(stat.sum2))
+    psnr = 10 * math.log10(255 ** 2 / mse) if mse else math.inf
+    return psnr, max(hi for _, hi in diff.getextrema())
+
+
+def bench(fn, img, repeat):
+    fn(img)  # ウォームアップ
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn(img)
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    renderer = WatermarkRenderer()
+    ok = True
+    print(f"{'入力サイズ':>12} {'旧実装 ms':>10} {'新実装 ms':>10} {'高速化':>8} {'PSNR dB':>8} {'最大差':>6}")
+    for size in SIZES:
+        img = sample_image(size)
+        psnr, worst = compare(legacy_crop_to_4_3_and_watermark(img), renderer.render(img))
+        ok &= psnr >= MIN_PSNR
+        old = bench(legacy_crop_to_4_3_and_watermark, img, args.repeat)
+        new = bench(renderer.render, img, args.repeat)
+        print(f"{size[0]:>6}x{size[1]:<5} {old * 1000:>10.1f} {new * 1000:>10.1f} {old / new:>7.2f}x {psnr:>8.1f} {worst:>6}")
+    if not ok:
+        print(f"PSNR が {MIN_PSNR} dB 未満の入力があります")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+from PIL import Image, ImageOps
+import argparse
+import io
+import os
+import pickle
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import db
+import generation
+import metrics
+from backends import FakeBackend, HedgedBackend
+from gallery import Gallery
+from generation import generate_record, GenerationFailed
+from image_cache import rendition_bytes
+from jobs import JobQueue
+from limiter import ApiLimiter, LimitedBackend
+
+# ==========================================
+# 🏋️ 負荷試験 (ネットワーク不要)
+# ==========================================
+# 実行: python -m benchmarks.load_test --sessions 16 --per-session 4
+# 本番と同じ生成経路 (前処理 → バックエンド → 透かし → レンディション → DB保存) を
+# FakeBackend で動かし、N セッションが同時に生成・評価する状況を再現する。
+# 一時ディレクトリの DB を使うので、本番の room_ai_history.db には触れない。
+
+
+def phone_photo(seed, size=(4032, 3024)):
+    # スマホ写真相当の大きさの JPEG (セッションごとに別の画像)
+    grad = Image.linear_gradient("L").rotate(seed * 37 % 360).resize(size)
+    img = ImageOps.colorize(grad, (seed * 13 % 128, 40, 60), (230, 210, 200 - seed * 7 % 100))
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+SELECTIONS = [
+    {"style": "北欧ナチュラル", "fabric": "ベージュ", "frame": "ナチュラルオーク", "floor": "ライトオーク", "wall": "ホワイト", "fitting": "ライトオーク"},
+    {"style": "モダン", "fabric": "ダークグレー", "frame": "マットブラック", "floor": "ライトグレー", "wall": "ホワイト", "fitting": "ウォールナット"},
+    {"style": "和風", "fabric": "グリーン", "frame": "チーク", "floor": "畳", "wall": "ホワイト", "fitting": "ライトオーク"},
+]
+
+
+def run_session(i, args, queue, backend, results):
+    # 1セッション分: 生成を投入し、完了を待ってギャラリーに追加・評価する
+    base = phone_photo(i % args.photos if args.photos else i)
+    gallery = Gallery()
+    stats = {"done": 0, "failed": 0, "latency": [], "queue_wait": []}
+    for n in range(args.per_session):
+        sel = SELECTIONS[(i + n) % len(SELECTIONS)]
+        job_id = queue.submit(generate_record, backend, base, [], sel, session_id=str(i))
+        while True:
+            job = queue.get(job_id)
+            if job.status in ("done", "failed"):
+                break
+            time.sleep(args.poll)
+        stats["latency"].append(job.finished_at - job.submitted_at)
+        if job.started_at:
+            stats["queue_wait"].append(job.started_at - job.submitted_at)
+        if job.status == "done":
+            stats["done"] += 1
+            gallery.append(job.result)
+            rendition_bytes(job.result["id"], "gen", "preview")
+            log = dict(job.result, rating=(i + n) % 5 + 1, action="保存")
+            db.save_to_db(log)
+        else:
+            stats["failed"] += 1
+            if not isinstance(job.error, GenerationFailed) and not generation.is_rate_limited(job.error):
+                stats.setdefault("errors", []).append(repr(job.error))
+        time.sleep(args.think)
+    stats["session_bytes"] = len(pickle.dumps(gallery))
+    results[i] = stats
+
+
+def pct(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=16, help="同時セッション数")
+    parser.add_argument("--per-session", type=int, default=3, help="1セッションあたりの生成回数")
+    parser.add_argument("--workers", type=int, default=8, help="生成ワーカー数")
+    parser.add_argument("--latency", type=float, default=1.0, help="バックエンドの平均遅延 (秒)")
+    parser.add_argument("--jitter", type=float, default=0.3)
+    parser.add_argument("--failure-rate", type=float, default=0.02)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.02)
+    parser.add_argument("--backoff", type=float, default=0.2, help="レート制限時のバックオフ基準 (秒)")
+    parser.add_argument("--think", type=float, default=0.1, help="生成の合間の操作時間 (秒)")
+    parser.add_argument("--poll", type=float, default=0.05, help="ジョブ状態の確認間隔 (秒)")
+    parser.add_argument("--quota-rpm", type=int, default=0, help="バックエンド側の割り当て (回/分)。超えると 429。0 なら無し")
+    parser.add_argument("--rpm", type=float, default=0, help="API 呼び出しの上限 (回/分)。0 なら制限しない")
+    parser.add_argument("--api-concurrency", type=int, default=6, help="API の同時呼び出し数の上限 (--rpm 指定時)")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="遅延が5倍になる呼び出しの割合 (応答時間の裾)")
+    parser.add_argument("--hedge", action="store_true", help="p95 を過ぎた呼び出しに予備リクエストを送る")
+    parser.add_argument("--photos", type=int, default=0,
+                        help="セッション間で使い回すベース写真の数 (同じ依頼は生成結果のキャッシュから返る)。0 ならセッションごとに別")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="room_ai_bench_")
+    db.DB_FILE = os.path.join(tmp, "bench.db")
+    metrics.METRICS_FILE = os.path.join(tmp, "metrics.prom")
+    generation.RATE_LIMIT_BACKOFF = args.backoff
+    db.init_db()
+
+    backend = FakeBackend(latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+                          rate_limit_rate=args.rate_limit_rate, seed=args.seed, quota_rpm=args.quota_rpm or None,
+                          slow_rate=args.slow_rate)
+    api = LimitedBackend(backend, ApiLimiter(args.rpm, concurrency=args.api_concurrency)) if args.rpm else backend
+    if args.hedge:
+        api = HedgedBackend(api)
+    queue = JobQueue(workers=args.workers)
+    results = {}
+
+    tracemalloc.start()
+    base_mem = tracemalloc.get_traced_memory()[0]
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=run_session, args=(i, args, queue, api, results)) for i in range(args.sessions)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+    cur_mem, peak_mem = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    done = sum(r["done"] for r in results.values())
+    failed = sum(r["failed"] for r in results.values())
+    latency = [x for r in results.values() for x in r["latency"]]
+    queue_wait = [x for r in results.values() for x in r["queue_wait"]]
+    session_bytes = [r["session_bytes"] for r in results.values()]
+
+    print(f"セッション {args.sessions} × {args.per_session} 回, ワーカー {args.workers}, バックエンド遅延 {args.latency}±{args.jitter}s")
+    print(f"所要時間 {wall:.2f}s  成功 {done}  失敗 {failed}  スループット {done / wall:.2f} 生成/秒  (API 呼び出し {backend.calls} 回)")
+    if args.hedge:
+        print(f"予備リクエスト {api.hedged} 回 (うち先に返った {api.hedge_wins} 回)")
+    print(f"生成待ち時間 (投入→完了)  p50 {pct(latency, 0.5):.2f}s  p95 {pct(latency, 0.95):.2f}s  最大 {max(latency, default=0):.2f}s")
+    print(f"キュー待ち (投入→開始)    p50 {pct(queue_wait, 0.5):.2f}s  p95 {pct(queue_wait, 0.95):.2f}s")
+
+    print("\nステージ別 (ms)")
+    print(f"{'ステージ':<10} {'件数':>6} {'エラー':>6} {'平均':>9} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for name, s in sorted(metrics.metrics.snapshot().items()):
+        ms = lambda v: float("nan") if v is None else v * 1000
+        print(f"{name:<10} {s['count']:>6} {s['errors']:>6} {ms(s['mean']):>9.1f} {ms(s['p50']):>9.1f} {ms(s['p95']):>9.1f} {ms(s['p99']):>9.1f}")
+
+    ls = db.lock_stats
+    print("\nDB ロック")
+    print(f"書き込み {ls['writes']} 回  ロック待ち 合計 {ls['lock_wait'] * 1000:.1f}ms / 最大 {ls['max_lock_wait'] * 1000:.1f}ms"
+          f"  接続待ち 合計 {ls['pool_wait'] * 1000:.1f}ms  busy エラー {ls['busy_errors']}")
+
+    print("\nメモリ")
+    print(f"セッション状態 (Gallery) 平均 {sum(session_bytes) / len(session_bytes) / 1024:.1f} KiB")
+    print(f"Python ヒープ増分 {(cur_mem - base_mem) / 1024 / 1024:.1f} MiB (ピーク {peak_mem / 1024 / 1024:.1f} MiB)"
+          f"  → 1セッションあたり {(peak_mem - base_mem) / args.sessions / 1024 / 1024:.2f} MiB (共有キャッシュ込み)")
+    print(f"最大 RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB")
+
+    errors = [e for r in results.values() for e in r.get("errors", [])]
+    if errors:
+        print(f"\n想定外のエラー {len(errors)} 件: {errors[0]}")
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
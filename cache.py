@@ -0,0 +1,48 @@
+import threading
+from collections import OrderedDict
+
+# ==========================================
+# 🗃️ プロセス共有の LRU キャッシュ
+# ==========================================
+# 全セッション・全ワーカースレッドで共有する。容量はバイト数で制限し、
+# 上限を超えたら最も長く使われていないものから捨てる。
+
+
+class LRUCache:
+    def __init__(self, max_bytes, sizeof=len):
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key][0]
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+        if size > self.max_bytes:
+            return value
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._bytes -= self._data.popitem(last=False)[1][1]
+        return value
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def nbytes(self):
+        return self._bytes
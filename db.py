@@ -0,0 +1,460 @@
+import sqlite3
+import hashlib
+import base64
+import math
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from imaging import RENDITION_ORDER
+
+# ==========================================
+# 💾 データベース設定 (スマホ・PC間 同期用)
+# ==========================================
+DB_FILE = "room_ai_history.db"
+
+# 接続はプロセス全体でプールして使い回す (セッション・ワーカー共通)
+POOL_SIZE = 8
+BUSY_TIMEOUT_MS = 5000
+
+# 画像本体は blobs テーブルにハッシュ(SHA-256)をキーとして一度だけ保存し、
+# history などの各行はハッシュ参照のみを持つ。参照数はトリガーで管理し、
+# 参照が 0 になった画像は自動的に削除される。
+BLOB_REFS = {"history": ["base_hash", "gen_hash"], "renditions": ["hash"], "result_cache_images": ["hash"]}
+
+# 旧形式 (base64 文字列) からの移行で一度に読む行数。1行にカメラ解像度の画像が2枚入っているので少なめ
+LEGACY_MIGRATE_BATCH = 20
+
+# 縮小版 (サムネイル・プレビュー) は renditions テーブルに保存する (サイズは imaging.RENDITIONS)。
+# 原寸は history.base_hash / gen_hash がそのまま参照する
+
+# 生成時の選択内容。desc の文字列とは別に列として保存する (絞り込み・分析用)
+SETTING_COLS = ["style", "fabric", "frame", "floor", "wall", "fitting", "custom_fabric", "custom_frame"]
+
+# rating_rollup に日別で積み上げる軸。dim="all" (value="") は全体の集計
+ROLLUP_DIMS = ["style", "fabric", "frame", "floor", "wall", "fitting"]
+
+
+def blob_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+# ==========================================
+# 🔌 接続プール
+# ==========================================
+class ConnectionPool:
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _open(self):
+        # isolation_level=None: トランザクションは connect(write=True) で明示的に張る
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        # 新規作成の DB だけに効く (既存の DB は retention.compact() で一度だけ切り替える)
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+        # WAL では NORMAL でもアプリのクラッシュで壊れない。コミットごとの fsync を省く
+        conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    def acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                return self._open()
+            except Exception:
+                self._slots.release()
+                raise
+
+    def release(self, conn):
+        self._idle.put(conn)
+        self._slots.release()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+# 接続待ち・書き込みロック待ちの累計 (負荷試験・監視用)
+lock_stats = {"writes": 0, "pool_wait": 0.0, "lock_wait": 0.0, "max_lock_wait": 0.0, "busy_errors": 0}
+_stats_lock = threading.Lock()
+
+
+def _record_wait(pool_wait, lock_wait=None, busy=False):
+    with _stats_lock:
+        lock_stats["pool_wait"] += pool_wait
+        if lock_wait is not None:
+            lock_stats["writes"] += 1
+            lock_stats["lock_wait"] += lock_wait
+            lock_stats["max_lock_wait"] = max(lock_stats["max_lock_wait"], lock_wait)
+        if busy:
+            lock_stats["busy_errors"] += 1
+
+
+def _pool():
+    with _pools_lock:
+        if DB_FILE not in _pools:
+            _pools[DB_FILE] = ConnectionPool(DB_FILE)
+        return _pools[DB_FILE]
+
+
+@contextmanager
+def connect(write=False):
+    # write=True のときは BEGIN IMMEDIATE で書き込みロックを先に取る
+    # (読み取りから書き込みへの昇格で SQLITE_BUSY になるのを防ぐ)
+    pool = _pool()
+    t0 = time.perf_counter()
+    conn = pool.acquire()
+    t1 = time.perf_counter()
+    try:
+        if write:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError:
+                _record_wait(t1 - t0, time.perf_counter() - t1, busy=True)
+                raise
+            _record_wait(t1 - t0, time.perf_counter() - t1)
+        else:
+            _record_wait(t1 - t0)
+        yield conn
+        if write:
+            conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        pool.release(conn)
+
+
+# ==========================================
+# 🧱 スキーマ移行 (PRAGMA user_version で管理)
+# ==========================================
+def _ref_triggers(table, cols):
+    new_refs = ", ".join(f"NEW.{c}" for c in cols)
+    old_refs = ", ".join(f"OLD.{c}" for c in cols)
+    inc = f"UPDATE blobs SET refcount = refcount + 1 WHERE hash IN ({new_refs});"
+    dec = (f"UPDATE blobs SET refcount = refcount - 1 WHERE hash IN ({old_refs});"
+           f" DELETE FROM blobs WHERE hash IN ({old_refs}) AND refcount <= 0;")
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {table}_blob_ins AFTER INSERT ON {table} BEGIN {inc} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_blob_del AFTER DELETE ON {table} BEGIN {dec} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_blob_upd AFTER UPDATE OF {', '.join(cols)} ON {table} BEGIN {inc} {dec} END",
+    ]
+
+
+def _put_blob(conn, data):
+    h = blob_hash(data)
+    conn.execute("INSERT INTO blobs (hash, data, size, refcount) VALUES (?, ?, ?, 0) ON CONFLICT (hash) DO NOTHING",
+                 (h, data, len(data)))
+    return h
+
+
+def _create_history(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS history
+                    (id TEXT PRIMARY KEY, timestamp REAL, base_hash TEXT, gen_hash TEXT, desc TEXT, rating INTEGER, action TEXT)''')
+    for sql in _ref_triggers("history", BLOB_REFS["history"]):
+        conn.execute(sql)
+
+
+def _migrate_1_blob_store(conn):
+    # 画像をハッシュ参照に。旧形式 (base64文字列を直接保持) の history があれば移行する
+    conn.execute('''CREATE TABLE IF NOT EXISTS blobs
+                    (hash TEXT PRIMARY KEY, data BLOB, size INTEGER, refcount INTEGER NOT NULL DEFAULT 0)''')
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(history)")]
+    if "base_img" not in cols:
+        _create_history(conn)
+        return
+    conn.execute("ALTER TABLE history RENAME TO history_legacy")
+    _create_history(conn)
+    # 全行を一度に読むと大きな DB では起動時にメモリが足りなくなるので、rowid 順に少しずつ移す
+    last = 0
+    while True:
+        rows = conn.execute("""SELECT rowid, id, timestamp, base_img, gen_img, desc, rating, action FROM history_legacy
+                               WHERE rowid > ? ORDER BY rowid LIMIT ?""", (last, LEGACY_MIGRATE_BATCH)).fetchall()
+        if not rows:
+            break
+        for last, row_id, ts, base_b64, gen_b64, desc, rating, action in rows:
+            base_h = _put_blob(conn, base64.b64decode(base_b64)) if base_b64 else None
+            gen_h = _put_blob(conn, base64.b64decode(gen_b64)) if gen_b64 else None
+            conn.execute("INSERT INTO history VALUES (?, ?, ?, ?, ?, ?, ?)", (row_id, ts, base_h, gen_h, desc, rating, action))
+        del rows
+    conn.execute("DROP TABLE history_legacy")
+
+
+def _migrate_2_history_indexes(conn):
+    # 管理画面の絞り込み・ページ送り用
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history (timestamp, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_history_rating ON history (rating, timestamp)")
+
+
+def _migrate_3_renditions(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS renditions
+                    (record_id TEXT, role TEXT, size TEXT, hash TEXT, PRIMARY KEY (record_id, role, size))''')
+    for sql in _ref_triggers("renditions", BLOB_REFS["renditions"]):
+        conn.execute(sql)
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS history_renditions_del AFTER DELETE ON history
+                    BEGIN DELETE FROM renditions WHERE record_id = OLD.id; END""")
+
+
+def _migrate_4_stage_metrics(conn):
+    # ステージ別処理時間 (metrics.py)。1分単位のヒストグラムと合計
+    conn.execute('''CREATE TABLE IF NOT EXISTS stage_metrics
+                    (minute INTEGER, stage TEXT, bucket INTEGER, count INTEGER, PRIMARY KEY (minute, stage, bucket))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS stage_totals
+                    (minute INTEGER, stage TEXT, count INTEGER, errors INTEGER, sum_seconds REAL, PRIMARY KEY (minute, stage))''')
+
+
+def _rollup_triggers():
+    # history の追加・削除・評価の更新に合わせて rating_rollup の件数を増減する。
+    # 件数が 0 になった行はその日の分だけ消す
+    def apply(ref, delta):
+        day = f"date({ref}.timestamp, 'unixepoch', 'localtime')"
+        dims = [("'all'", "''")] + [(f"'{d}'", f"COALESCE({ref}.{d}, '')") for d in ROLLUP_DIMS]
+        stmts = [f"INSERT INTO rating_rollup VALUES ({day}, {dim}, {value}, {ref}.rating, {ref}.action, {delta})"
+                 f" ON CONFLICT (dim, day, value, rating, action) DO UPDATE SET count = count + excluded.count;"
+                 for dim, value in dims]
+        if delta < 0:
+            stmts.append(f"DELETE FROM rating_rollup WHERE dim IN ({', '.join(d for d, _ in dims)}) AND day = {day} AND count <= 0;")
+        return " ".join(stmts)
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS history_rollup_ins AFTER INSERT ON history BEGIN {apply('NEW', 1)} END",
+        f"CREATE TRIGGER IF NOT EXISTS history_rollup_del AFTER DELETE ON history BEGIN {apply('OLD', -1)} END",
+        f"CREATE TRIGGER IF NOT EXISTS history_rollup_upd AFTER UPDATE OF rating, action ON history"
+        f" WHEN OLD.rating IS NOT NEW.rating OR OLD.action IS NOT NEW.action"
+        f" BEGIN {apply('OLD', -1)} {apply('NEW', 1)} END",
+    ]
+
+
+def _parse_desc(desc):
+    # 旧レコード用: "style / 張地:... / フレーム:..." から選択内容を復元する (床・壁・建具は記録が無い)
+    parts = (desc or "").split(" / ")
+    if len(parts) != 3 or not parts[1].startswith("張地:") or not parts[2].startswith("フレーム:"):
+        return None
+    style, fabric, frame = parts[0], parts[1][len("張地:"):], parts[2][len("フレーム:"):]
+    return {"style": None if style == "modern" else style, "fabric": fabric, "frame": frame}
+
+
+def _migrate_5_settings_rollup(conn):
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(history)")]
+    for col in SETTING_COLS:
+        if col not in cols:
+            conn.execute(f"ALTER TABLE history ADD COLUMN {col} {'INTEGER' if col.startswith('custom_') else 'TEXT'}")
+    for col in ["style", "fabric", "frame"]:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_history_{col} ON history ({col}, rating)")
+
+    for row_id, desc in conn.execute("SELECT id, desc FROM history WHERE style IS NULL AND fabric IS NULL").fetchall():
+        sel = _parse_desc(desc)
+        if sel:
+            conn.execute("UPDATE history SET style = ?, fabric = ?, frame = ?, custom_fabric = ?, custom_frame = ? WHERE id = ?",
+                         (sel["style"], sel["fabric"], sel["frame"],
+                          int(sel["fabric"] == "独自画像"), int(sel["frame"] == "独自画像"), row_id))
+
+    # 軸 × 日別 × 選択肢 × 評価 × アクション の件数。既存の履歴から一度だけ作り、以降はトリガーで更新する
+    conn.execute('''CREATE TABLE IF NOT EXISTS rating_rollup
+                    (day TEXT, dim TEXT, value TEXT, rating INTEGER, action TEXT, count INTEGER,
+                     PRIMARY KEY (dim, day, value, rating, action))''')
+    conn.execute("DELETE FROM rating_rollup")
+    for dim, value in [("all", "''")] + [(d, f"COALESCE({d}, '')") for d in ROLLUP_DIMS]:
+        conn.execute(f"""INSERT INTO rating_rollup
+                         SELECT date(timestamp, 'unixepoch', 'localtime') AS day, ?, {value} AS v, rating, action, COUNT(*)
+                         FROM history GROUP BY day, v, rating, action""", (dim,))
+    for sql in _rollup_triggers():
+        conn.execute(sql)
+
+
+def _migrate_6_archive(conn):
+    # 保持期間を過ぎて画像を ZIP に移したレコードは base_hash / gen_hash が NULL になり、
+    # archive に移動先のファイル名が入る (retention.py)
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(history)")]
+    if "archive" not in cols:
+        conn.execute("ALTER TABLE history ADD COLUMN archive TEXT")
+
+
+def _migrate_7_updated_at(conn):
+    # 管理画面のライブ表示用。追加・評価の更新・アーカイブのたびに change_time() の値を入れ、
+    # (updated_at, id) をカーソルにして前回以降に変わった行だけを読む
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(history)")]
+    if "updated_at" not in cols:
+        conn.execute("ALTER TABLE history ADD COLUMN updated_at REAL")
+    conn.execute("UPDATE history SET updated_at = timestamp WHERE updated_at IS NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_history_updated ON history (updated_at, id)")
+
+
+def _migrate_8_result_cache(conn):
+    # 生成結果のキャッシュ (result_cache.py)。画像は renditions と同じくハッシュ参照
+    conn.execute('''CREATE TABLE IF NOT EXISTS result_cache
+                    (key TEXT PRIMARY KEY, created REAL, last_used REAL, bytes INTEGER, hits INTEGER NOT NULL DEFAULT 0)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_result_cache_used ON result_cache (last_used)")
+    conn.execute('''CREATE TABLE IF NOT EXISTS result_cache_images
+                    (key TEXT, role TEXT, size TEXT, hash TEXT, PRIMARY KEY (key, role, size))''')
+    for sql in _ref_triggers("result_cache_images", BLOB_REFS["result_cache_images"]):
+        conn.execute(sql)
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS result_cache_images_cascade AFTER DELETE ON result_cache
+                    BEGIN DELETE FROM result_cache_images WHERE key = OLD.key; END""")
+
+
+def _migrate_9_setting_indexes(conn):
+    # 5 では style / fabric / frame だけだったので、集計軸 (ROLLUP_DIMS) の残りにも同じ索引を張る。
+    # custom_fabric / custom_frame は 0/1 しかなく索引が効かないので張らない
+    for col in ROLLUP_DIMS:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_history_{col} ON history ({col}, rating)")
+
+
+# 追加のみ。並び順がそのままスキーマのバージョン番号になる
+MIGRATIONS = [
+    _migrate_1_blob_store,
+    _migrate_2_history_indexes,
+    _migrate_3_renditions,
+    _migrate_4_stage_metrics,
+    _migrate_5_settings_rollup,
+    _migrate_6_archive,
+    _migrate_7_updated_at,
+    _migrate_8_result_cache,
+    _migrate_9_setting_indexes,
+]
+
+_initialized = set()
+_init_lock = threading.Lock()
+
+
+def init_db():
+    # プロセスごとに一度だけ未適用のスキーマ移行を実行する (再実行のたびには走らない)
+    with _init_lock:
+        if DB_FILE in _initialized:
+            return
+        with connect(write=True) as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for i, migrate in enumerate(MIGRATIONS[version:], start=version + 1):
+                migrate(conn)
+                conn.execute(f"PRAGMA user_version = {i}")
+        _initialized.add(DB_FILE)
+
+
+# ==========================================
+# 📝 履歴の読み書き
+# ==========================================
+def change_time(conn):
+    # history を書き換える書き込みトランザクション内で呼ぶ (書き込みは BEGIN IMMEDIATE で直列)。
+    # 時計が戻っても直前の値より必ず大きくし、ライブ表示のカーソルが取りこぼさないようにする
+    last = conn.execute("SELECT MAX(updated_at) FROM history").fetchone()[0] or 0.0
+    return max(time.time(), math.nextafter(last, math.inf))
+
+
+def save_to_db(data, renditions=None):
+    # renditions: 新規レコードの画像 {"base": {"thumb": JPEG, ..., "full": JPEG}, "gen": {...}}。
+    # 既存レコードなら評価とアクションだけを更新する (1文の UPSERT)
+    with connect(write=True) as conn:
+        for role, sizes in (renditions or {}).items():
+            for size, img in sizes.items():
+                h = _put_blob(conn, img)
+                if size != "full":
+                    conn.execute("""INSERT INTO renditions VALUES (?, ?, ?, ?)
+                                    ON CONFLICT (record_id, role, size) DO UPDATE SET hash = excluded.hash""",
+                                 (data['id'], role, size, h))
+        conn.execute(f"""INSERT INTO history ({HISTORY_COLS}, updated_at) VALUES ({", ".join("?" * (len(HISTORY_KEYS) + 1))})
+                         ON CONFLICT (id) DO UPDATE SET rating = excluded.rating, action = excluded.action,
+                                                        updated_at = excluded.updated_at""",
+                     [data.get(k) for k in HISTORY_KEYS] + [change_time(conn)])
+
+
+def load_blob(h):
+    with connect() as conn:
+        row = conn.execute("SELECT data FROM blobs WHERE hash=?", (h,)).fetchone()
+    return row[0] if row else None
+
+
+def load_rendition(record_id, role, size):
+    # 指定サイズ以上で最も小さいレンディションを返す。縮小版の無い旧レコードは原寸
+    wanted = RENDITION_ORDER[RENDITION_ORDER.index(size):]
+    with connect() as conn:
+        rows = dict(conn.execute("SELECT size, hash FROM renditions WHERE record_id=? AND role=?", (record_id, role)).fetchall())
+        h = next((rows[s] for s in wanted if s in rows), None)
+        if h is None:
+            # 縮小版の無い旧レコードは原寸。レコードが無ければ None (アーカイブ済みと同じ扱い)
+            row = conn.execute(f"SELECT {role}_hash FROM history WHERE id=?", (record_id,)).fetchone()
+            if row is None:
+                return None
+            h = row[0]
+        row = conn.execute("SELECT data FROM blobs WHERE hash=?", (h,)).fetchone()
+    return row[0] if row else None
+
+
+HISTORY_KEYS = ["id", "timestamp", "base_hash", "gen_hash", "desc", "rating", "action"] + SETTING_COLS + ["archive"]
+HISTORY_COLS = ", ".join(HISTORY_KEYS)
+
+
+def row_to_log(row):
+    # SELECT {HISTORY_COLS} の1行 → 履歴の dict (export.py・retention.py も使う)
+    return dict(zip(HISTORY_KEYS, row))
+
+
+def load_record(record_id):
+    with connect() as conn:
+        row = conn.execute(f"SELECT {HISTORY_COLS} FROM history WHERE id=?", (record_id,)).fetchone()
+    return row_to_log(row) if row else None
+
+
+def history_filters(min_rating=None, action=None, since=None, until=None):
+    # 管理画面・エクスポート共通の絞り込み条件 → (WHERE 句のリスト, パラメータ)
+    where, params = [], []
+    if min_rating is not None:
+        where.append("rating >= ?")
+        params.append(min_rating)
+    if action:
+        where.append("action = ?")
+        params.append(action)
+    if since is not None:
+        where.append("timestamp >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("timestamp < ?")
+        params.append(until)
+    return where, params
+
+
+def count_history(**filters):
+    where, params = history_filters(**filters)
+    sql = "SELECT COUNT(*) FROM history" + (" WHERE " + " AND ".join(where) if where else "")
+    with connect() as conn:
+        return conn.execute(sql, params).fetchone()[0]
+
+
+def query_history(limit=20, cursor=None, **filters):
+    # 新しい順に limit 件ずつ返す。cursor は前ページ最後の (timestamp, id)。
+    # 画像本体は含まず、必要な行だけ load_blob で後から読み込む。
+    where, params = history_filters(**filters)
+    if cursor is not None:
+        where.append("(timestamp < ? OR (timestamp = ? AND id < ?))")
+        params += [cursor[0], cursor[0], cursor[1]]
+    sql = f"SELECT {HISTORY_COLS} FROM history"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+    with connect() as conn:
+        rows = conn.execute(sql, params + [limit + 1]).fetchall()
+
+    logs = [row_to_log(r) for r in rows[:limit]]
+    next_cursor = (logs[-1]['timestamp'], logs[-1]['id']) if len(rows) > limit else None
+    return logs, next_cursor
+
+
+def history_changes(cursor=None, limit=30):
+    # 管理画面のライブ表示用。cursor (前回の updated_at, id) より後に追加・更新された行のうち、
+    # 新しいもの limit 件を更新順 (古い → 新しい) に返す。cursor が None なら直近 limit 件。
+    # 返り値は (logs, 次の cursor)。変わった行が無ければ cursor はそのまま
+    sql = f"SELECT {HISTORY_COLS}, updated_at FROM history"
+    params = []
+    if cursor is not None:
+        sql += " WHERE updated_at > ? OR (updated_at = ? AND id > ?)"
+        params = [cursor[0], cursor[0], cursor[1]]
+    sql += " ORDER BY updated_at DESC, id DESC LIMIT ?"
+    with connect() as conn:
+        rows = conn.execute(sql, params + [limit]).fetchall()
+    if not rows:
+        return [], cursor
+    return [row_to_log(r[:-1]) for r in reversed(rows)], (rows[0][-1], rows[0][0])
@@ -0,0 +1,156 @@
+import argparse
+import csv
+import io
+import json
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+
+import db
+from db import connect, history_filters
+
+# ==========================================
+# 📦 履歴の一括エクスポート (ZIP / NDJSON / CSV)
+# ==========================================
+# 管理画面と同じ条件 (評価・アクション・期間) で絞り込んだ履歴を書き出す。
+# 行は1本のカーソルから EXPORT_BATCH 件ずつ取り出し、画像も1枚ずつ読んで
+# そのまま出力先へ書くので、件数が増えてもメモリ使用量は変わらない。
+# 実行: python -m export --since 2025-01-01 --min-rating 4 -o history.zip
+EXPORT_BATCH = 200
+EXPORT_FORMATS = {"zip": "application/zip", "ndjson": "application/x-ndjson", "csv": "text/csv"}
+MANIFEST_FIELDS = ["id", "timestamp", "datetime", "desc", "rating", "action"] + db.SETTING_COLS + ["base_file", "gen_file"]
+
+
+def iter_history(conn, **filters):
+    # 古い順に1行ずつ返す。fetchall() せず fetchmany() で少しずつ読む
+    where, params = history_filters(**filters)
+    sql = f"SELECT {db.HISTORY_COLS} FROM history"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY timestamp ASC, id ASC"
+    cur = conn.execute(sql, params)
+    while True:
+        rows = cur.fetchmany(EXPORT_BATCH)
+        if not rows:
+            break
+        for row in rows:
+            yield db.row_to_log(row)
+
+
+def _manifest_row(log, with_files):
+    row = {"id": log["id"], "timestamp": log["timestamp"],
+           "datetime": datetime.fromtimestamp(log["timestamp"]).isoformat(timespec="seconds") if log["timestamp"] else None,
+           "desc": log["desc"], "rating": log["rating"], "action": log["action"]}
+    row.update((k, log[k]) for k in db.SETTING_COLS)
+    if with_files:
+        row["base_file"] = f"base/{log['id']}.jpg" if log["base_hash"] else None
+        row["gen_file"] = f"gen/{log['id']}.jpg" if log["gen_hash"] else None
+    return row
+
+
+class _ManifestWriter:
+    # NDJSON または CSV を1行ずつ書き出す (out はテキストストリーム)
+    def __init__(self, out, fmt, with_files):
+        self.out = out
+        self.fmt = fmt
+        self.with_files = with_files
+        if fmt == "csv":
+            fields = MANIFEST_FIELDS if with_files else MANIFEST_FIELDS[:-2]
+            self._csv = csv.DictWriter(out, fieldnames=fields)
+            self._csv.writeheader()
+
+    def write(self, log):
+        row = _manifest_row(log, self.with_files)
+        if self.fmt == "csv":
+            self._csv.writerow(row)
+        else:
+            self.out.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+def write_export(out, fmt="zip", manifest="ndjson", **filters):
+    # out: バイナリで書き込めるファイル。書き出した件数を返す。
+    # zip は base/<id>.jpg, gen/<id>.jpg と manifest.ndjson (または .csv) を含む
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"unknown export format: {fmt}")
+    count = 0
+    with connect() as conn:
+        if fmt != "zip":
+            text = io.TextIOWrapper(out, encoding="utf-8", newline="", write_through=True)
+            writer = _ManifestWriter(text, fmt, with_files=False)
+            for log in iter_history(conn, **filters):
+                writer.write(log)
+                count += 1
+            text.detach()
+            return count
+
+        # ZIP は同時に1エントリしか書けないので、マニフェストは一時ファイルに溜めて最後に追加する。
+        # 画像は保存済みの JPEG をそのまま格納 (再圧縮しない)
+        with tempfile.TemporaryFile() as tmp, zipfile.ZipFile(out, "w", compression=zipfile.ZIP_STORED) as zf:
+            text = io.TextIOWrapper(tmp, encoding="utf-8", newline="")
+            writer = _ManifestWriter(text, manifest, with_files=True)
+            for log in iter_history(conn, **filters):
+                for role in ("base", "gen"):
+                    h = log[f"{role}_hash"]
+                    row = conn.execute("SELECT data FROM blobs WHERE hash=?", (h,)).fetchone() if h else None
+                    if row:
+                        zf.writestr(f"{role}/{log['id']}.jpg", row[0])
+                writer.write(log)
+                count += 1
+            text.flush()
+            text.detach()
+            tmp.seek(0)
+            with zf.open(f"manifest.{manifest}", "w", force_zip64=True) as dst:
+                shutil.copyfileobj(tmp, dst)
+    return count
+
+
+def export_file(fmt="zip", **filters):
+    # 一時ファイルに書き出し、先頭に戻したファイルを返す (st.download_button の遅延生成用)
+    f = tempfile.TemporaryFile()
+    write_export(f, fmt, **filters)
+    f.seek(0)
+    return f
+
+
+def export_filename(fmt):
+    return f"room_ai_history_{datetime.now():%Y%m%d_%H%M}.{fmt}"
+
+
+def _parse_date(s):
+    return time.mktime(datetime.strptime(s, "%Y-%m-%d").timetuple())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="履歴を ZIP / NDJSON / CSV で書き出す")
+    parser.add_argument("-o", "--output", required=True, help="出力ファイル (- で標準出力)")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), help="省略時は出力ファイルの拡張子から判断")
+    parser.add_argument("--manifest", choices=["ndjson", "csv"], default="ndjson", help="ZIP に含めるマニフェストの形式")
+    parser.add_argument("--since", help="この日以降 (YYYY-MM-DD)")
+    parser.add_argument("--until", help="この日まで (YYYY-MM-DD, その日を含む)")
+    parser.add_argument("--min-rating", type=int)
+    parser.add_argument("--action", choices=["閲覧のみ", "保存", "再作成"])
+    parser.add_argument("--db", default=db.DB_FILE)
+    args = parser.parse_args()
+
+    fmt = args.format or args.output.rsplit(".", 1)[-1]
+    if fmt not in EXPORT_FORMATS:
+        parser.error("--format を指定してください (zip / ndjson / csv)")
+    filters = {"min_rating": args.min_rating, "action": args.action,
+               "since": _parse_date(args.since) if args.since else None,
+               "until": _parse_date(args.until) + 86400 if args.until else None}
+
+    db.DB_FILE = args.db
+    db.init_db()
+    if args.output == "-":
+        n = write_export(sys.stdout.buffer, fmt, args.manifest, **filters)
+    else:
+        with open(args.output, "wb") as f:
+            n = write_export(f, fmt, args.manifest, **filters)
+    print(f"{n} 件を書き出しました", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+from collections import OrderedDict
+from db import load_record
+from image_cache import rendition_bytes
+
+# ==========================================
+# 🖼️ セッションごとのギャラリー
+# ==========================================
+# セッションには全記録の ID と、直近 GALLERY_KEEP 件の記録・サムネイルだけを持つ。
+# それより古い記録はスライダーで選ばれたときに DB から読み直す。
+GALLERY_KEEP = 8
+
+
+class Gallery:
+    def __init__(self):
+        self.ids = []
+        self._recent = OrderedDict()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, log):
+        entry = dict(log, thumb=rendition_bytes(log["id"], "gen", "thumb"))
+        self.ids.append(log["id"])
+        self._recent[log["id"]] = entry
+        while len(self._recent) > GALLERY_KEEP:
+            self._recent.popitem(last=False)
+
+    def __getitem__(self, idx):
+        # DB から消えた記録 (保持期間の処理など) は ID ごとギャラリーから外して None を返す
+        record_id = self.ids[idx]
+        entry = self._recent.get(record_id)
+        if entry is None:
+            entry = load_record(record_id)
+            if entry is None:
+                self.ids.remove(record_id)
+        return entry
+
+    def recent(self):
+        # (ギャラリー内の番号, 記録) を古い順に
+        start = len(self.ids) - len(self._recent)
+        return list(enumerate(self._recent.values(), start=start))
@@ -0,0 +1,72 @@
+import os
+import threading
+
+from backends import GeminiBackend, HedgedBackend
+from limiter import LimitedBackend, get_limiter
+
+# ==========================================
+# ♊ Gemini クライアント (プロセス全体で1つ)
+# ==========================================
+# google.generativeai の import (約1秒) は、最初に必要になったとき (生成画面を開いたとき
+# の warm() か、最初の生成) まで遅らせる。トップページや管理画面では読み込まない。
+# configure() とモデルの作成はプロセスごとに一度だけ行い、SDK の接続 (gRPC チャネル) を
+# 全セッションで使い回す。各呼び出しには REQUEST_TIMEOUT 秒のタイムアウトを付ける。
+MODEL_NAME = "models/gemini-3-pro-image-preview"
+REQUEST_TIMEOUT = 120
+# ROOM_AI_GEMINI_HEDGE=1 のとき、応答が直近の p95 より遅い呼び出しに予備の2本目を送る
+# (先に返った方を使う。API の呼び出し回数はその分増える)
+HEDGE = os.environ.get("ROOM_AI_GEMINI_HEDGE") == "1"
+
+
+class GeminiClient:
+    def __init__(self, api_key, model_name=MODEL_NAME, timeout=REQUEST_TIMEOUT):
+        self.api_key = api_key
+        self.model_name = model_name
+        self.timeout = timeout
+        self._model = None
+        self._lock = threading.Lock()
+
+    def model(self):
+        with self._lock:
+            if self._model is None:
+                import google.generativeai as genai
+                genai.configure(api_key=self.api_key)
+                self._model = genai.GenerativeModel(self.model_name)
+            return self._model
+
+    def warm(self):
+        # SDK の読み込みとモデルの作成を裏で済ませておく (画面の表示は待たせない)
+        if self._model is None:
+            threading.Thread(target=self.model, name="gemini-warm", daemon=True).start()
+
+    def generate_content(self, inputs):
+        return self.model().generate_content(inputs, request_options={"timeout": self.timeout})
+
+
+_client = None
+_backend = None
+_client_lock = threading.Lock()
+
+
+def get_client(api_key):
+    global _client, _backend
+    with _client_lock:
+        if _client is None or _client.api_key != api_key:
+            _client = GeminiClient(api_key)
+            _backend = None
+        return _client
+
+
+def get_backend(api_key):
+    # 生成に使うバックエンド: (予備リクエスト →) 流量制御 → Gemini
+    global _backend
+    client = get_client(api_key)
+    with _client_lock:
+        if _backend is None:
+            limiter = get_limiter()
+            backend = LimitedBackend(GeminiBackend(client), limiter)
+            if HEDGE:
+                # 流量制御で待ちが出ているときは予備を送らない
+                backend = HedgedBackend(backend, allow=lambda: not limiter.status()["waiting"])
+            _backend = backend
+        return _backend
@@ -0,0 +1,129 @@
+from PIL import Image
+import io
+import time
+import random
+import itertools
+import uuid
+from db import save_to_db, blob_hash
+from imaging import make_renditions, crop_to_4_3_and_watermark, BASE_FULL_MAX_SIDE
+from preprocess import prepare_image, model_part
+from metrics import stage
+from result_cache import result_key, cached_renditions
+
+# ==========================================
+# 🤖 画像生成処理 (ワーカースレッドから実行)
+# ==========================================
+# st.session_state には触れず、受け取ったスナップショットだけで完結させる
+SELECTION_KEYS = ['style', 'fabric', 'frame', 'floor', 'wall', 'fitting']
+
+# レート制限 (429 / quota) の場合のみ、ジッター付き指数バックオフで再試行する
+RATE_LIMIT_RETRIES = 4
+RATE_LIMIT_BACKOFF = 2.0
+
+
+class GenerationFailed(Exception):
+    pass
+
+
+def snapshot_selection(state):
+    # 選択内容を名前だけの辞書にする (アップロードファイル等はワーカーに渡さない)
+    return {k: (state[k]["name"] if state[k] else None) for k in SELECTION_KEYS}
+
+
+def build_prompt(sel):
+    fab_p = "" if sel["fabric"] == "変更なし" else f"Upholstery: {sel['fabric']}."
+    frame_p = "" if sel["frame"] == "変更なし" else f"Frame/Legs: {sel['frame']}."
+    style_p = sel["style"] or "modern"
+    floor_p = sel["floor"] or "matching"
+    wall_p = sel["wall"] or "matching"
+    fitting_p = sel["fitting"] or "matching"
+
+    return f"""
+                    GENERATE_IMAGE: Create a highly realistic interior design photo.
+                    Furniture: The sofa from the first attached image. Maintain exact shape.
+                    {fab_p} {frame_p}
+                    Style: {style_p} interior.
+                    Interior: Floor: {floor_p}, Walls: {wall_p}, Doors/Fittings: {fitting_p}.
+                    """
+
+
+def variant_selections(sel, fabrics, frames, styles, style_defaults):
+    # 張地 × フレーム × テイスト の組み合わせを展開する。空のリストは現在の選択のまま
+    out = []
+    for fab, frm, sty in itertools.product(fabrics or [sel["fabric"]], frames or [sel["frame"]], styles or [sel["style"]]):
+        v = dict(sel, fabric=fab, frame=frm, style=sty)
+        if sty != sel["style"] and sty in style_defaults:
+            v.update(style_defaults[sty])
+        out.append(v)
+    return out
+
+
+def describe(sel):
+    desc_str = f"{sel['style'] or 'modern'} / "
+    desc_str += f"張地:{sel['fabric']} / "
+    desc_str += f"フレーム:{sel['frame']}"
+    return desc_str
+
+
+def selection_columns(sel):
+    # history の設定列 (db.SETTING_COLS) の値
+    cols = {k: sel.get(k) for k in SELECTION_KEYS}
+    cols["custom_fabric"] = int(sel.get("fabric") == "独自画像")
+    cols["custom_frame"] = int(sel.get("frame") == "独自画像")
+    return cols
+
+
+def is_rate_limited(e):
+    msg = str(e).lower()
+    return getattr(e, "code", None) == 429 or "429" in msg or "quota" in msg or "resource exhausted" in msg
+
+
+def call_with_backoff(fn, *args):
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        try:
+            return fn(*args)
+        except Exception as e:
+            if attempt == RATE_LIMIT_RETRIES or not is_rate_limited(e):
+                raise
+            time.sleep(RATE_LIMIT_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def generate_record(backend, base_bytes, textures, sel, fresh=False):
+    # 生成 (backends.py) → 透かし → DB保存 までを行い、ギャラリー用の記録を返す
+    # textures は前処理済み (prepare_image 済み) の JPEG バイト列
+    # 同じ依頼の結果は result_cache から返す。fresh=True (再作成) はキャッシュを使わずに生成する
+    with stage("total"):
+        with stage("decode"):
+            base_jpeg = prepare_image(base_bytes)
+        with stage("prompt"):
+            prompt = build_prompt(sel)
+            inputs = [prompt, model_part(base_jpeg)]
+            for tex in textures:
+                inputs.append(model_part(tex))
+
+        def render():
+            with stage("gemini"):
+                gen_img = call_with_backoff(backend.generate, inputs)
+                if not gen_img:
+                    raise GenerationFailed("生成に失敗しました。")
+
+            with stage("watermark"):
+                final_img = crop_to_4_3_and_watermark(gen_img)
+            with stage("encode"):
+                return {"base": make_renditions(Image.open(io.BytesIO(base_jpeg)), BASE_FULL_MAX_SIDE),
+                        "gen": make_renditions(final_img)}
+
+        renditions = cached_renditions(result_key(backend.name, base_jpeg, textures, prompt), render, fresh)
+        new_log = {
+            # 並列のジョブやキャッシュからの結果は同じ時刻に終わることがあるので、id は時刻にしない (並び順は timestamp)
+            "id": uuid.uuid4().hex,
+            "timestamp": time.time(),
+            "base_hash": blob_hash(renditions["base"]["full"]),
+            "gen_hash": blob_hash(renditions["gen"]["full"]),
+            "desc": describe(sel),
+            "rating": 0, "action": "閲覧のみ",
+            **selection_columns(sel),
+        }
+        with stage("save_db"):
+            save_to_db(new_log, renditions=renditions)
+    return new_log
@@ -0,0 +1,68 @@
+import io
+from cache import LRUCache
+from db import load_blob, load_rendition
+from imaging import jpeg_to_pil
+
+# ==========================================
+# 🖼️ 画像キャッシュ (プロセス全体で共有)
+# ==========================================
+# レンディションは保存後に変わらないので、全セッション・再実行をまたいで使い回す。
+# 表示用 (st.image) には JPEG バイト列をそのまま渡す。PIL 画像を渡すと
+# Streamlit が再実行のたびに再エンコードするため。デコード済みの画像は
+# ピクセルが必要な処理 (ダウンロード用の変換など) のために別枠で持つ。
+ENCODED_CACHE_BYTES = 64 * 1024 * 1024
+DECODED_CACHE_BYTES = 192 * 1024 * 1024
+ARTIFACT_CACHE_BYTES = 96 * 1024 * 1024
+
+# ダウンロード用の形式 {形式: (MIME, 拡張子, Pillow の保存オプション)}。
+# jpeg は保存済みの原寸 JPEG をそのまま返す (再エンコードしても画質は上がらないため)
+ARTIFACT_FORMATS = {
+    "png": ("image/png", "png", {"format": "PNG"}),
+    "webp": ("image/webp", "webp", {"format": "WEBP", "quality": 90, "method": 4}),
+    "jpeg": ("image/jpeg", "jpg", None),
+}
+
+
+def _pixel_bytes(img):
+    return img.width * img.height * len(img.getbands())
+
+
+_encoded = LRUCache(ENCODED_CACHE_BYTES)
+_decoded = LRUCache(DECODED_CACHE_BYTES, sizeof=_pixel_bytes)
+_artifacts = LRUCache(ARTIFACT_CACHE_BYTES)
+
+
+def rendition_bytes(record_id, role, size):
+    key = (record_id, role, size)
+    data = _encoded.get(key)
+    if data is None:
+        data = load_rendition(record_id, role, size)
+        if data is not None:
+            _encoded.put(key, data)
+    return data
+
+
+def blob_image(h):
+    # 原寸画像 (ハッシュ指定) をデコードして返す。呼び出し側で書き換えないこと
+    img = _decoded.get(h)
+    if img is None:
+        img = jpeg_to_pil(load_blob(h))
+        img.load()
+        _decoded.put(h, img)
+    return img
+
+
+def artifact_bytes(record, fmt):
+    # 生成結果 (record) をダウンロード用の形式に変換したバイト列。(生成ID, 形式) ごとに一度だけエンコードする
+    key = (record["id"], fmt)
+    data = _artifacts.get(key)
+    if data is None:
+        options = ARTIFACT_FORMATS[fmt][2]
+        if options is None:
+            data = load_blob(record["gen_hash"])
+        else:
+            buf = io.BytesIO()
+            blob_image(record["gen_hash"]).save(buf, **options)
+            data = buf.getvalue()
+        _artifacts.put(key, data)
+    return data
@@ -0,0 +1,115 @@
+from PIL import Image, ImageDraw, ImageFont
+import io
+import threading
+
+# ==========================================
+# 🖼️ 画像処理関数
+# ==========================================
+# 保存時に一度だけ作るレンディション (小さい順)。None は原寸
+RENDITIONS = {"thumb": (400, 300), "preview": (800, 600), "full": None}
+RENDITION_ORDER = list(RENDITIONS)
+
+# カメラ画像をそのまま原寸で保存しないよう、ベース画像の原寸は長辺をここまでに抑える
+BASE_FULL_MAX_SIDE = 1600
+
+# 生成結果の出力サイズ
+OUTPUT_SIZE = (1200, 900)
+
+
+def pil_to_jpeg(img, quality=85):
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def jpeg_to_pil(data):
+    return Image.open(io.BytesIO(data))
+
+
+def make_renditions(img, max_side=None):
+    # {"thumb": JPEG, "preview": JPEG, "full": JPEG} を返す
+    img = img.convert("RGB")
+    if max_side and max(img.size) > max_side:
+        img = img.copy()
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    out = {}
+    for name, box in RENDITIONS.items():
+        if box is None:
+            out[name] = pil_to_jpeg(img)
+        else:
+            small = img.copy()
+            small.thumbnail(box, Image.Resampling.LANCZOS)
+            out[name] = pil_to_jpeg(small, quality=80)
+    return out
+
+
+class WatermarkRenderer:
+    # 4:3 に切り抜いて出力サイズへ縮小し、透かしを入れる。
+    # フォントの読み込み・文字の配置・文字の形 (マスク) の描画は出力サイズごとに一度だけ行い、
+    # 毎回はマスクを通して色を塗るだけにする。影 → 文字の順に不透明で塗るので、
+    # 透かしは ImageDraw.text を2回呼んでいた以前の処理と同じ画素になる。
+    # 出力の REDUCE_MIN 倍以上ある入力は、先に reduce() (整数分の1の平均) で縮めてから LANCZOS をかける。
+    # LANCZOS だけで縮めた場合との差は PSNR 30 dB 以上で、4096x3072 の入力なら3倍以上速い
+    # (benchmarks/bench_watermark.py)
+    SHADOW_INK = (0, 0, 0, 120)
+    TEXT_INK = (255, 255, 255, 240)
+    REDUCE_MIN = 2
+    REDUCE_MODES = {"L", "RGB", "RGBA"}  # reduce() が使えるモード (それ以外は LANCZOS だけで縮める)
+
+    def __init__(self, text="HOTTA WOODWORKS-DX", margin=30):
+        self.text = text
+        self.margin = margin
+        self._overlays = {}
+        self._lock = threading.Lock()
+
+    def _build_overlay(self, size):
+        # 透かしを3倍に
+        try: font = ImageFont.truetype("LiberationSans-Regular.ttf", int(size[1] * 0.075))
+        except: font = ImageFont.load_default()
+
+        bbox = ImageDraw.Draw(Image.new("L", (1, 1))).textbbox((0, 0), self.text, font=font)
+        tw, th = bbox[2] - bbox[0], bbox[3] - bbox[1]
+        x, y = size[0] - tw - self.margin, size[1] - th - self.margin
+        # マスクは文字の範囲 (影の 2px を含む) だけの大きさで作り、(x, y) からのずれ分ずらして貼る
+        ox, oy = max(0, -bbox[0]), max(0, -bbox[1])
+        mw, mh = ox + bbox[2] + 2, oy + bbox[3] + 2
+        shadow = Image.new("L", (mw, mh), 0)
+        ImageDraw.Draw(shadow).text((ox + 2, oy + 2), self.text, font=font, fill=255)
+        text = Image.new("L", (mw, mh), 0)
+        ImageDraw.Draw(text).text((ox, oy), self.text, font=font, fill=255)
+        return shadow, text, (x - ox, y - oy, x - ox + mw, y - oy + mh)
+
+    def overlay(self, size):
+        with self._lock:
+            if size not in self._overlays:
+                self._overlays[size] = self._build_overlay(size)
+            return self._overlays[size]
+
+    def render(self, img, size=OUTPUT_SIZE):
+        # 切り抜きを先にして、範囲外の画素は縮小で読まない
+        w, h = img.size
+        target_ratio = size[0] / size[1]
+        if w / h > target_ratio:
+            new_w = int(h * target_ratio)
+            img = img.crop(((w - new_w) / 2, 0, (w - new_w) / 2 + new_w, h))
+        else:
+            new_h = int(w / target_ratio)
+            img = img.crop((0, (h - new_h) / 2, w, (h - new_h) / 2 + new_h))
+
+        factor = min(img.width // size[0], img.height // size[1])
+        if factor >= self.REDUCE_MIN and img.mode in self.REDUCE_MODES:
+            img = img.reduce(factor)
+        img = img.resize(size, Image.Resampling.LANCZOS)
+
+        shadow, text, box = self.overlay(size)
+        img.paste(self.SHADOW_INK, box, shadow)
+        img.paste(self.TEXT_INK, box, text)
+        return img
+
+
+_watermark = WatermarkRenderer()
+
+
+def crop_to_4_3_and_watermark(img):
+    # 1200x900にリサイズして透かしを入れる
+    return _watermark.render(img)
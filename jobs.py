@@ -0,0 +1,172 @@
+import threading
+import itertools
+import time
+from collections import deque
+
+# ==========================================
+# 🧵 生成ジョブキュー (プロセス全体で共有)
+# ==========================================
+# Streamlit のスクリプト実行スレッドは投入と状態確認だけを行い、
+# 実際の生成はワーカースレッドが処理する。再実行やウィジェット操作で
+# 処理が中断されることはない。
+# 待ち行列はセッションごとの FIFO を交互に取り出す (公平キュー)。
+# まとめて生成で一度に多く投入したセッションがいても、他のセッションの順番は後回しにならない。
+GEN_WORKERS = 8
+JOB_TTL = 30 * 60  # 完了後この秒数が過ぎたジョブは破棄
+MAX_QUEUED = 64  # 待ち行列全体の上限。超えた投入は受け付けない (待ち時間が読めなくなるため)
+MAX_QUEUED_PER_SESSION = 16
+EXPECTED_RUNTIME = 30.0  # 実績が無いときの 1 件あたりの生成時間 (秒) の見込み
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, job_id, fn, args, session_id, group):
+        self.id = job_id
+        self.seq = 0
+        self.tag = 0  # 公平キューの仮想時刻。小さい順に実行する
+        self.fn = fn
+        self.args = args
+        self.session_id = session_id
+        self.group = group
+        self.status = "queued"  # queued / running / done / failed
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+
+class JobQueue:
+    def __init__(self, workers=GEN_WORKERS):
+        self.workers = workers
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        # グループ (バッチ) ごとの同時実行数の上限と実行中の数
+        self._group_limits = {}
+        self._group_running = {}
+        # 公平キュー: 最後に取り出したジョブのタグと、セッションごとの最後のタグ
+        self._vtime = 0
+        self._last_tag = {}
+        # 1 件あたりの実行時間 (指数移動平均)。待ち時間の目安に使う
+        self._avg_runtime = EXPECTED_RUNTIME
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"gen-worker-{i}", daemon=True).start()
+
+    def submit(self, fn, *args, session_id=None, group=None, group_limit=None):
+        with self._cond:
+            self._prune()
+            if len(self._pending) >= MAX_QUEUED:
+                raise QueueFull("ただいま混み合っています。しばらくしてからもう一度お試しください。")
+            if session_id is not None and sum(1 for j in self._pending if j.session_id == session_id) >= MAX_QUEUED_PER_SESSION:
+                raise QueueFull(f"同時に待てる生成は {MAX_QUEUED_PER_SESSION} 件までです。")
+            seq = next(self._ids)
+            job = Job(f"job-{seq}", fn, args, session_id, group)
+            job.seq = seq
+            # 同じセッションのジョブは前のジョブの次、他のセッションとは交互になる
+            job.tag = max(self._vtime, self._last_tag.get(session_id, 0)) + 1
+            self._last_tag[session_id] = job.tag
+            if group is not None and group_limit:
+                self._group_limits[group] = group_limit
+            self._jobs[job.id] = job
+            self._pending.append(job)
+            self._cond.notify()
+            return job.id
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def _ahead(self, job):
+        # job より先に取り出される待ちジョブの数 (グループの上限は考えない)
+        return sum(1 for j in self._pending if (j.tag, j.seq) < (job.tag, job.seq))
+
+    def position(self, job_id):
+        # 待ち行列での順番 (1始まり)。実行中・完了なら 0
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.status != "queued":
+                return 0
+            return self._ahead(job) + 1
+
+    def estimate_wait(self, job_id, rate=None):
+        # 完了までの残り時間の目安 (秒)。rate は API の上限 (件/秒)。分からなければ None
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished_at:
+                return None
+            if job.status == "running":
+                return max(0.0, self._avg_runtime - (time.time() - job.started_at))
+            ahead = self._ahead(job)
+            running = sum(self._group_running.values())
+            # 前のジョブと実行中のジョブでワーカーが埋まっている分だけ待つ
+            wait = max(0, ahead + running - self.workers + 1) / self.workers * self._avg_runtime
+            if rate:
+                wait = max(wait, ahead / rate)
+            return wait + self._avg_runtime
+
+    def _prune(self):
+        now = time.time()
+        for job_id in [j.id for j in self._jobs.values() if j.finished_at and now - j.finished_at > JOB_TTL]:
+            del self._jobs[job_id]
+        active = {j.group for j in self._jobs.values() if not j.finished_at}
+        for group in [g for g in self._group_limits if g not in active]:
+            del self._group_limits[group]
+        # 追いつかれたセッションのタグは次の投入で _vtime に置き換わるので不要
+        for session_id in [s for s, tag in self._last_tag.items() if tag <= self._vtime]:
+            del self._last_tag[session_id]
+
+    def _next_job(self):
+        # 所属グループが上限に達していないジョブのうち、タグが最も小さいものを取り出す
+        best = None
+        for job in self._pending:
+            limit = self._group_limits.get(job.group)
+            if (not limit or self._group_running.get(job.group, 0) < limit) and \
+                    (best is None or (job.tag, job.seq) < (best.tag, best.seq)):
+                best = job
+        if best is not None:
+            self._pending.remove(best)
+            self._vtime = max(self._vtime, best.tag)
+        return best
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                job.status = "running"
+                job.started_at = time.time()
+                self._group_running[job.group] = self._group_running.get(job.group, 0) + 1
+            try:
+                result, status, error = job.fn(*job.args), "done", None
+            except Exception as e:
+                result, status, error = None, "failed", e
+            with self._cond:
+                job.result, job.status, job.error = result, status, error
+                job.finished_at = time.time()
+                job.fn = job.args = None
+                if status == "done":
+                    self._avg_runtime += 0.2 * (job.finished_at - job.started_at - self._avg_runtime)
+                self._group_running[job.group] -= 1
+                if not self._group_running[job.group]:
+                    del self._group_running[job.group]
+                # 上限で待たされていたジョブを動かせるよう全ワーカーを起こす
+                self._cond.notify_all()
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+        return _queue
@@ -0,0 +1,137 @@
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from generation import is_rate_limited
+from metrics import metrics
+
+# ==========================================
+# 🚦 API 呼び出しの流量制御 (プロセス全体で共有)
+# ==========================================
+# 全セッション・全ワーカーの Gemini 呼び出しをここで絞る。
+# ・トークンバケット: 平均 GEMINI_RPM 回/分、瞬間的には GEMINI_BURST 回まで (0 以下なら回数の制限なし)
+# ・同時実行数: GEMINI_MAX_CONCURRENCY (前処理・保存は制限しないのでワーカー数より少なくてよい)
+# ・待っている呼び出しは到着順 (FIFO) に通す
+# ・429 / quota が返ったら全体で一時停止し (ジッター付きで倍々に延長)、成功したら元に戻す
+# セッション間の公平さ (順番の割り当て) は jobs.JobQueue が受け持つ
+GEMINI_RPM = float(os.environ.get("ROOM_AI_GEMINI_RPM", 20))
+GEMINI_BURST = 4
+GEMINI_MAX_CONCURRENCY = 6
+COOLDOWN_MIN = 2.0
+COOLDOWN_MAX = 60.0
+
+
+class ApiLimiter:
+    def __init__(self, rpm=GEMINI_RPM, burst=GEMINI_BURST, concurrency=GEMINI_MAX_CONCURRENCY):
+        self.rate = rpm / 60 if rpm > 0 else None  # None: 回数の制限なし (同時実行数・一時停止だけ効く)
+        self.burst = burst
+        self.concurrency = concurrency
+        self._cond = threading.Condition()
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._running = 0
+        self._next_ticket = 0
+        self._serving = 0
+        self._abandoned = set()  # 順番が来る前に待つのをやめた番号
+        self._paused_until = 0.0
+        self._cooldown = 0.0
+
+    def _refill(self, now):
+        if self.rate is None:
+            self._tokens = float(self.burst)
+        else:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _release(self, ticket):
+        # 番号を使い終えた (または手放した)。先頭なら、手放された番号を飛ばして次へ進める
+        if ticket != self._serving:
+            self._abandoned.add(ticket)
+            return
+        self._serving += 1
+        while self._serving in self._abandoned:
+            self._abandoned.remove(self._serving)
+            self._serving += 1
+
+    @contextmanager
+    def slot(self):
+        t0 = time.perf_counter()
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if ticket != self._serving or self._running >= self.concurrency:
+                        self._cond.wait()
+                    elif now < self._paused_until:
+                        self._cond.wait(self._paused_until - now)
+                    elif self._tokens < 1:
+                        self._cond.wait((1 - self._tokens) / self.rate)
+                    else:
+                        break
+                self._tokens -= 1
+                self._running += 1
+            finally:
+                # 待っている間に例外 (KeyboardInterrupt など) で抜けても番号は手放し、後ろを止めない
+                self._release(ticket)
+                self._cond.notify_all()
+        # 制限による待ち時間 (gemini ステージの内訳)
+        metrics.observe("api_wait", time.perf_counter() - t0)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._cond.notify_all()
+
+    def penalize(self):
+        # レート制限を受けたら全体を止める。続けて受けるほど長く止める
+        with self._cond:
+            self._cooldown = min(COOLDOWN_MAX, max(COOLDOWN_MIN, self._cooldown * 2))
+            self._paused_until = max(self._paused_until, time.monotonic() + self._cooldown * random.uniform(0.5, 1.5))
+            self._tokens = 0.0
+
+    def succeeded(self):
+        with self._cond:
+            self._cooldown = 0.0
+
+    def status(self):
+        # 画面表示用 {waiting, running, paused (残り秒)}
+        with self._cond:
+            return {"waiting": self._next_ticket - self._serving - len(self._abandoned), "running": self._running,
+                    "paused": max(0.0, self._paused_until - time.monotonic())}
+
+
+class LimitedBackend:
+    # バックエンドの generate() を ApiLimiter 経由で呼ぶ。再試行 (generation.call_with_backoff) も毎回ここを通る
+    def __init__(self, backend, limiter):
+        self.backend = backend
+        self.limiter = limiter
+        self.name = backend.name
+
+    def generate(self, inputs):
+        with self.limiter.slot():
+            try:
+                result = self.backend.generate(inputs)
+            except Exception as e:
+                if is_rate_limited(e):
+                    self.limiter.penalize()
+                raise
+        self.limiter.succeeded()
+        return result
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter():
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = ApiLimiter()
+        return _limiter
@@ -0,0 +1,211 @@
+import bisect
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from db import connect
+
+# ==========================================
+# 📊 処理時間の計測 (ステージ別ヒストグラム)
+# ==========================================
+# generation の各ステージを stage() で囲むと、所要時間とエラー数を記録する。
+# メモリ上で集計し、FLUSH_INTERVAL ごとに 1分単位のヒストグラムとして
+# stage_metrics / stage_totals テーブルへ書き出す (管理画面の p50/p95/p99 用)。
+# 同時に Prometheus のテキスト形式を METRICS_FILE に書き出し、
+# 環境変数 ROOM_AI_METRICS_PORT があればそのポートで /metrics を公開する。
+# 書き出しと /metrics はアプリの起動時に start() で始める (最初の生成を待たない)。
+# DB にはバケットの番号で保存するので、既存の境界は変更・並べ替えしないこと
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 7.5, 10, 12.5, 15, 20, 25, 30, 45, 60, 120, float("inf")]
+FLUSH_INTERVAL = 10
+METRICS_FILE = "metrics.prom"
+METRICS_PORT = os.environ.get("ROOM_AI_METRICS_PORT")
+
+logger = logging.getLogger(__name__)
+
+
+class StageMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Prometheus 用の累積値 {stage: [bucket counts, sum, count, errors]}
+        self._totals = {}
+        # DB へ未書き出しの差分 {(minute, stage): [bucket counts, sum, count, errors]}
+        self._pending = {}
+        self._flusher = None
+
+    def observe(self, stage, seconds, ok=True):
+        b = bisect.bisect_left(BUCKETS, seconds)
+        minute = int(time.time() // 60 * 60)
+        with self._lock:
+            for key, table in ((stage, self._totals), ((minute, stage), self._pending)):
+                rec = table.setdefault(key, [[0] * len(BUCKETS), 0.0, 0, 0])
+                rec[0][b] += 1
+                rec[1] += seconds
+                rec[2] += 1
+                rec[3] += 0 if ok else 1
+        # アプリからは起動時に start() 済み。負荷試験などアプリ外で使われたとき用
+        if self._flusher is None:
+            self.start()
+
+    @contextmanager
+    def stage(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe(name, time.perf_counter() - t, ok=False)
+            raise
+        self.observe(name, time.perf_counter() - t)
+
+    def start(self):
+        # 定期書き出しのスレッドと /metrics の HTTP サーバーを一度だけ起動する
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name="metrics-flusher", daemon=True)
+        self._flusher.start()
+        if METRICS_PORT:
+            try:
+                server = ThreadingHTTPServer(("127.0.0.1", int(METRICS_PORT)), _MetricsHandler)
+            except OSError:
+                # ポートが使えなくても計測自体は続ける (ファイル出力のみ)
+                logger.exception("metrics: /metrics をポート %s で公開できません", METRICS_PORT)
+                return
+            threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.try_flush()
+
+    def try_flush(self):
+        # 書き出しに失敗しても呼び出し元 (定期実行・管理画面) は止めない。未書き出しの分は次回に持ち越し
+        try:
+            self.flush()
+            return True
+        except Exception:
+            logger.exception("metrics: 書き出しに失敗しました (未書き出しの分は次回に持ち越し)")
+            return False
+
+    def _restore(self, pending):
+        # DB への書き出しに失敗した差分を戻す (その間に増えた分と合算する)
+        with self._lock:
+            for key, (counts, total, n, errors) in pending.items():
+                rec = self._pending.setdefault(key, [[0] * len(BUCKETS), 0.0, 0, 0])
+                rec[0] = [a + b for a, b in zip(rec[0], counts)]
+                rec[1] += total
+                rec[2] += n
+                rec[3] += errors
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if pending:
+            try:
+                with connect(write=True) as conn:
+                    for (minute, stage), (counts, total, n, errors) in pending.items():
+                        conn.executemany("""INSERT INTO stage_metrics VALUES (?, ?, ?, ?)
+                                            ON CONFLICT (minute, stage, bucket) DO UPDATE SET count = count + excluded.count""",
+                                         [(minute, stage, i, c) for i, c in enumerate(counts) if c])
+                        conn.execute("""INSERT INTO stage_totals VALUES (?, ?, ?, ?, ?)
+                                        ON CONFLICT (minute, stage) DO UPDATE SET count = count + excluded.count,
+                                            errors = errors + excluded.errors, sum_seconds = sum_seconds + excluded.sum_seconds""",
+                                     (minute, stage, n, errors, total))
+            except Exception:
+                # トランザクションごと取り消されているので、そのまま次回に書き直せる
+                self._restore(pending)
+                raise
+        # 定期実行と管理画面の flush() が同時に走っても互いの一時ファイルを消さないよう、名前は毎回変える
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(METRICS_FILE)),
+                                         prefix=".metrics.", suffix=".tmp", delete=False) as f:
+            f.write(self.prometheus_text())
+        try:
+            os.replace(f.name, METRICS_FILE)
+        except OSError:
+            os.unlink(f.name)
+            raise
+
+    def snapshot(self):
+        # プロセス起動以降の累積 {stage: {count, errors, mean, p50, p95, p99}}
+        with self._lock:
+            totals = {k: (list(v[0]), v[1], v[2], v[3]) for k, v in self._totals.items()}
+        return {name: {"count": n, "errors": errors, "mean": total / n if n else None,
+                       "p50": _percentile(counts, 0.5), "p95": _percentile(counts, 0.95), "p99": _percentile(counts, 0.99)}
+                for name, (counts, total, n, errors) in totals.items()}
+
+    def prometheus_text(self):
+        with self._lock:
+            totals = {k: (list(v[0]), v[1], v[2], v[3]) for k, v in self._totals.items()}
+        lines = ["# HELP room_ai_stage_seconds Time spent in each generation stage.",
+                 "# TYPE room_ai_stage_seconds histogram"]
+        for stage, (counts, total, n, _) in sorted(totals.items()):
+            acc = 0
+            for le, c in zip(BUCKETS, counts):
+                acc += c
+                le_s = "+Inf" if le == float("inf") else f"{le:g}"
+                lines.append(f'room_ai_stage_seconds_bucket{{stage="{stage}",le="{le_s}"}} {acc}')
+            lines.append(f'room_ai_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+            lines.append(f'room_ai_stage_seconds_count{{stage="{stage}"}} {n}')
+        lines += ["# HELP room_ai_stage_errors_total Failed executions of each generation stage.",
+                  "# TYPE room_ai_stage_errors_total counter"]
+        for stage, (_, _, _, errors) in sorted(totals.items()):
+            lines.append(f'room_ai_stage_errors_total{{stage="{stage}"}} {errors}')
+        return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+metrics = StageMetrics()
+stage = metrics.stage
+
+
+def _percentile(counts, q):
+    # バケット内は線形補間。最後のバケット (上限なし) は一つ前の上限を返す
+    n = sum(counts)
+    if not n:
+        return None
+    rank, acc = q * n, 0
+    for i, c in enumerate(counts):
+        if c and acc + c >= rank:
+            lo = BUCKETS[i - 1] if i else 0.0
+            hi = BUCKETS[i]
+            if hi == float("inf"):
+                return lo
+            return lo + (hi - lo) * (rank - acc) / c
+        acc += c
+    return BUCKETS[-2]
+
+
+def stage_report(since, period=3600):
+    # 期間ごと・ステージごとの件数、エラー数、平均、p50/p95/p99 (秒)。period=None なら全体で1行
+    period = period or 1 << 40
+    with connect() as conn:
+        hist = conn.execute("""SELECT minute / ? * ? AS p, stage, bucket, SUM(count) FROM stage_metrics
+                               WHERE minute >= ? GROUP BY p, stage, bucket""", (period, period, since)).fetchall()
+        totals = conn.execute("""SELECT minute / ? * ? AS p, stage, SUM(count), SUM(errors), SUM(sum_seconds) FROM stage_totals
+                                 WHERE minute >= ? GROUP BY p, stage ORDER BY p, stage""", (period, period, since)).fetchall()
+    counts = {}
+    for p, name, b, c in hist:
+        counts.setdefault((p, name), [0] * len(BUCKETS))[b] += c
+    rows = []
+    for p, name, n, errors, total in totals:
+        c = counts.get((p, name), [0] * len(BUCKETS))
+        rows.append({"period": p, "stage": name, "count": n, "errors": errors, "mean": total / n if n else None,
+                     "p50": _percentile(c, 0.5), "p95": _percentile(c, 0.95), "p99": _percentile(c, 0.99)})
+    return rows
@@ -0,0 +1,41 @@
+from PIL import Image, ImageOps
+import io
+from cache import LRUCache
+from db import blob_hash
+from imaging import pil_to_jpeg
+
+# ==========================================
+# 📐 入力画像の前処理 (Gemini へ送る前)
+# ==========================================
+# スマホの写真 (12〜48MP) をそのまま送らず、EXIF の向きを直して
+# モデルが活かせる解像度まで縮小し、JPEG で再エンコードしておく。
+# SDK に PIL 画像を渡すと可逆 WebP で再エンコードされて巨大になるため、
+# JPEG バイト列のまま inline_data として渡す。
+MODEL_INPUT_MAX_SIDE = 1536
+TEXTURE_MAX_SIDE = 768
+INPUT_JPEG_QUALITY = 90
+
+# 同じ写真での再作成・連続生成では前処理済みの結果を使い回す
+_prepared = LRUCache(max_bytes=64 * 1024 * 1024)
+
+
+def prepare_image(data, max_side=MODEL_INPUT_MAX_SIDE):
+    key = (blob_hash(data), max_side)
+    cached = _prepared.get(key)
+    if cached is not None:
+        return cached
+
+    img = Image.open(io.BytesIO(data))
+    # JPEG は DCT の段階で縮小してデコードする (原寸を展開しない)。長辺が max_side を下回らない範囲で最小に
+    w, h = img.size
+    scale = max_side / max(w, h)
+    if scale < 1:
+        img.draft("RGB", (max(1, int(w * scale)), max(1, int(h * scale))))
+    img = ImageOps.exif_transpose(img)
+    if max(img.size) > max_side:
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    return _prepared.put(key, pil_to_jpeg(img, quality=INPUT_JPEG_QUALITY))
+
+
+def model_part(jpeg):
+    return {"mime_type": "image/jpeg", "data": jpeg}
@@ -0,0 +1,133 @@
+from PIL import Image, ImageFilter
+import numpy as np
+import hashlib
+import io
+
+from cache import LRUCache
+
+# ==========================================
+# 🎨 簡易プレビュー (AI を使わない色替え)
+# ==========================================
+# ベース写真を色でいくつかの領域に分け (k-means)、中央にある最大の領域を張地、
+# その下側にある別の領域をフレームとみなして、選んだ色に置き換える。
+# 明暗 (陰影) は元の写真のものを残す。AI の生成が終わるまでの間と、
+# 「色を試す」での見比べ用の目安で、形の変更や素材感の再現はしない。
+PREVIEW_MAX_SIDE = 640
+SEGMENT_SAMPLES = 20000  # k-means に使う画素数
+CLUSTERS = 5
+KMEANS_ITERS = 10
+MIN_FRAME_AREA = 0.005  # フレームとみなす領域の最小面積 (画像全体に対する割合)
+PREVIEW_JPEG_QUALITY = 85
+
+_segments = LRUCache(64 * 1024 * 1024, sizeof=lambda seg: sum(a.nbytes for a in seg))
+_previews = LRUCache(16 * 1024 * 1024)
+
+
+def hex_to_rgb(value):
+    value = value.lstrip("#")
+    return tuple(int(value[i:i + 2], 16) for i in (0, 2, 4))
+
+
+def _features(rgb):
+    # 色味 (正規化した r, g) を重く、明るさを軽く見る。陰影で同じ布が別の領域に割れないように
+    total = rgb.sum(-1, keepdims=True) + 1e-6
+    chroma = rgb[..., :2] / total
+    lum = rgb.mean(-1, keepdims=True) / 255
+    return np.concatenate([chroma * 4, lum], axis=-1).astype(np.float32)
+
+
+def _kmeans(x, k, iters):
+    # 明るさの分位点で初期化する (乱数を使わないので、同じ写真なら毎回同じ結果)
+    order = np.argsort(x[:, -1])
+    centers = x[order[np.linspace(0, len(x) - 1, k).astype(int)]].copy()
+    for _ in range(iters):
+        labels = ((x[:, None, :] - centers[None]) ** 2).sum(-1).argmin(1)
+        for j in range(k):
+            members = x[labels == j]
+            if len(members):
+                centers[j] = members.mean(0)
+    return centers
+
+
+def _segment(img):
+    # (張地マスク, フレームマスク) を 0〜1 の float32 で返す
+    rgb = np.asarray(img, dtype=np.float32)
+    h, w, _ = rgb.shape
+    feats = _features(rgb).reshape(-1, 3)
+    step = max(1, len(feats) // SEGMENT_SAMPLES)
+    centers = _kmeans(feats[::step], CLUSTERS, KMEANS_ITERS)
+    labels = ((feats[:, None, :] - centers[None]) ** 2).sum(-1).argmin(1).reshape(h, w)
+
+    # 中央 (やや下寄り) ほど重く、画像の縁に接している領域 (床・壁) は軽く見る
+    yy, xx = np.mgrid[0:h, 0:w]
+    center_w = np.exp(-(((xx - w / 2) / (w * 0.3)) ** 2 + ((yy - h * 0.55) / (h * 0.3)) ** 2))
+    border = np.zeros((h, w), bool)
+    border[:3], border[-3:], border[:, :3], border[:, -3:] = True, True, True, True
+    # 領域ごとの画素数と、そのうち縁にある割合。k-means で空になった領域は選ばない (-inf)
+    sizes = np.bincount(labels.ravel(), minlength=CLUSTERS)
+    edge = np.bincount(labels[border], minlength=CLUSTERS) / np.maximum(sizes, 1)
+    scores = [center_w[labels == j].sum() * (1 - edge[j] * 5) if sizes[j] else -np.inf for j in range(CLUSTERS)]
+    fabric = int(np.argmax(scores))
+    fabric_mask = labels == fabric
+
+    # フレーム: 張地の範囲の下側 40% から脚の分 (高さの 1/4) 下までにある、張地以外で最も多い領域
+    frame_mask = np.zeros((h, w), bool)
+    ys, xs = np.nonzero(fabric_mask)
+    if len(ys):
+        top, bottom = ys.min(), ys.max()
+        left, right = xs.min(), xs.max()
+        y0, y1 = int(top + (bottom - top) * 0.6), min(h, int(bottom + (bottom - top) * 0.25) + 1)
+        region = labels[y0:y1, left:right + 1]
+        counts = [(region == j).sum() * (1 - edge[j] * 5) if j != fabric and sizes[j] else -np.inf for j in range(CLUSTERS)]
+        frame = int(np.argmax(counts))
+        if np.isfinite(counts[frame]) and (region == frame).sum() >= MIN_FRAME_AREA * h * w:
+            frame_mask[y0:y1, left:right + 1] = region == frame
+
+    return _soften(fabric_mask), _soften(frame_mask)
+
+
+def _soften(mask):
+    # 小さな点を消してから境界をぼかす (PIL のフィルタで十分)
+    m = Image.fromarray(mask.astype(np.uint8) * 255)
+    m = m.filter(ImageFilter.MinFilter(3)).filter(ImageFilter.MaxFilter(3)).filter(ImageFilter.GaussianBlur(1.5))
+    return np.asarray(m, dtype=np.float32) / 255
+
+
+def _tint(rgb, lum, mask, color):
+    # 陰影を残したまま色を置き換える。マスク内の明るさの中央値を基準に、暗い所は暗く・明るい所は白に寄せる
+    inside = lum[mask > 0.5]
+    if not inside.size:
+        return rgb
+    shade = lum / max(float(np.median(inside)), 1e-3)
+    target = np.asarray(hex_to_rgb(color), dtype=np.float32) / 255
+    dark = target * np.minimum(shade, 1.0)[..., None]
+    light = (1 - target) * np.clip(shade - 1.0, 0, 1)[..., None]
+    new = np.clip(dark + light, 0, 1) * 255
+    return rgb * (1 - mask[..., None]) + new * mask[..., None]
+
+
+def quick_preview(jpeg, fabric=None, frame=None):
+    # jpeg: 前処理済みのベース写真。fabric / frame: "#rrggbb" (None は変更なし)。JPEG を返す
+    h = hashlib.sha256(jpeg).hexdigest()
+    key = (h, fabric, frame)
+    data = _previews.get(key)
+    if data is not None:
+        return data
+
+    img = Image.open(io.BytesIO(jpeg)).convert("RGB")
+    if max(img.size) > PREVIEW_MAX_SIDE:
+        img.thumbnail((PREVIEW_MAX_SIDE, PREVIEW_MAX_SIDE), Image.Resampling.BILINEAR)
+    seg = _segments.get(h)
+    if seg is None:
+        seg = _segments.put(h, _segment(img))
+    fabric_mask, frame_mask = seg
+
+    rgb = np.asarray(img, dtype=np.float32)
+    lum = rgb.mean(-1) / 255
+    if fabric:
+        rgb = _tint(rgb, lum, fabric_mask, fabric)
+    if frame:
+        rgb = _tint(rgb, lum, frame_mask, frame)
+    buf = io.BytesIO()
+    Image.fromarray(rgb.astype(np.uint8)).save(buf, format="JPEG", quality=PREVIEW_JPEG_QUALITY)
+    return _previews.put(key, buf.getvalue())
@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import threading
+import time
+
+import db
+from db import connect, blob_hash
+from metrics import stage
+
+# ==========================================
+# ♻️ 生成結果のキャッシュ (同じ依頼では Gemini を呼ばない)
+# ==========================================
+# キーは 前処理済みのベース画像・独自画像・組み立てたプロンプト・バックエンド名 のハッシュ。
+# 結果 (ベースと生成画像の各サイズ) は blobs に置き、result_cache_images はハッシュ参照だけを
+# 持つので、再起動後も使え、history と同じ画像が二重に保存されることもない。
+# ・作成から RESULT_CACHE_TTL 秒を過ぎたものは使わない (保存のたびとメンテナンスで削除)
+# ・参照している画像の合計が RESULT_CACHE_MAX_BYTES を超えたら、最後に使われたのが古いものから外す
+# ・同じキーの生成が実行中なら、後から来た方はその結果を待つ (Gemini の呼び出しは1回)。
+#   INFLIGHT_WAIT 秒を過ぎても終わらなければ待つのをやめて自分で生成する
+# ・キャッシュの読み書きに失敗しても生成は止めない (読めなければ生成し、保存できなければ記録だけ残す)
+# 「再作成」は別の結果を得るための操作なので、キャッシュを読まずに生成し、結果で置き換える
+RESULT_CACHE_TTL = 14 * 86400
+RESULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+INFLIGHT_WAIT = 300  # 再試行 (generation.call_with_backoff) と流量制御の待ちを含めても十分な長さ
+
+logger = logging.getLogger(__name__)
+
+
+def result_key(backend_name, base_jpeg, textures, prompt):
+    h = hashlib.sha256()
+    # プロンプトは空白の違いを無視する (組み立て時のインデントなど)
+    for part in [backend_name, blob_hash(base_jpeg), *(blob_hash(t) for t in textures), " ".join(prompt.split())]:
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def lookup(key, now=None):
+    # {"base": {"thumb": JPEG, ...}, "gen": {...}} か None
+    now = now or time.time()
+    with connect() as conn:
+        found = conn.execute("SELECT 1 FROM result_cache WHERE key = ? AND created >= ?",
+                             (key, now - RESULT_CACHE_TTL)).fetchone()
+        if found is None:
+            return None
+        rows = conn.execute("""SELECT i.role, i.size, b.data FROM result_cache_images i
+                               JOIN blobs b ON b.hash = i.hash WHERE i.key = ?""", (key,)).fetchall()
+    with connect(write=True) as conn:
+        conn.execute("UPDATE result_cache SET last_used = ?, hits = hits + 1 WHERE key = ?", (now, key))
+    out = {}
+    for role, size, data in rows:
+        out.setdefault(role, {})[size] = data
+    return out
+
+
+def store(key, renditions, now=None):
+    now = now or time.time()
+    with connect(write=True) as conn:
+        # 置き換えの場合は先に古い方を消す (共有していない画像はここで消え、下で入れ直される)
+        conn.execute("DELETE FROM result_cache WHERE key = ?", (key,))
+        total = sum(len(img) for sizes in renditions.values() for img in sizes.values())
+        conn.execute("INSERT INTO result_cache (key, created, last_used, bytes) VALUES (?, ?, ?, ?)", (key, now, now, total))
+        for role, sizes in renditions.items():
+            for size, img in sizes.items():
+                conn.execute("INSERT INTO result_cache_images VALUES (?, ?, ?, ?)", (key, role, size, db._put_blob(conn, img)))
+        _evict(conn, now)
+
+
+def _evict(conn, now):
+    removed = conn.execute("DELETE FROM result_cache WHERE created < ?", (now - RESULT_CACHE_TTL,)).rowcount
+    over = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM result_cache").fetchone()[0] - RESULT_CACHE_MAX_BYTES
+    if over > 0:
+        victims = []
+        for key, size in conn.execute("SELECT key, bytes FROM result_cache ORDER BY last_used"):
+            if over <= 0:
+                break
+            victims.append(key)
+            over -= size
+        conn.executemany("DELETE FROM result_cache WHERE key = ?", [(k,) for k in victims])
+        removed += len(victims)
+    return removed
+
+
+def prune(now=None):
+    # 期限切れ・容量超過の分を削除し、削除した件数を返す (retention のメンテナンスから呼ぶ)
+    with connect(write=True) as conn:
+        return _evict(conn, now or time.time())
+
+
+class _Flight:
+    # 実行中の生成。同じキーで後から来た呼び出しは done を待って result / error を受け取る
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def _try_lookup(key):
+    # 読めなかった (database is locked など) ときはキャッシュにないものとして生成に進む
+    try:
+        return lookup(key)
+    except Exception:
+        logger.exception("result_cache: 読み出しに失敗しました (生成して続行)")
+        return None
+
+
+def cached_renditions(key, render, fresh=False):
+    # render() は生成処理 ({"base": {...}, "gen": {...}} を返す)。キャッシュにあればそれを返し、
+    # 同じキーの生成が実行中ならその結果を待つ。fresh (再作成) は必ず render() を呼ぶ
+    flight = None
+    if not fresh:
+        with stage("cache"):
+            hit = _try_lookup(key)
+        if hit is not None:
+            return hit
+        with _inflight_lock:
+            flight = _inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _inflight[key] = _Flight()
+        if not leader:
+            if flight.done.wait(INFLIGHT_WAIT):
+                if flight.error is not None:
+                    raise flight.error
+                return flight.result
+            # 先の生成が終わらない。いつまでもワーカーを塞がないよう自分で生成する (結果は共有しない)
+            flight = None
+
+    # ここから先は何が起きても flight を終わらせる (残ると同じキーの後続が待ち続ける)
+    try:
+        # 直前に別の生成が終わって保存されていた場合
+        hit = _try_lookup(key) if flight else None
+        result = hit if hit is not None else render()
+        if hit is None:
+            try:
+                store(key, result)
+            except Exception:
+                # 生成は済んでいるので結果は返す (次の同じ依頼はキャッシュに当たらないだけ)
+                logger.exception("result_cache: 保存に失敗しました")
+    except BaseException as e:
+        if flight:
+            flight.error = e
+            _finish(key, flight)
+        raise
+    if flight:
+        _finish(key, flight, result)
+    return result
+
+
+def _finish(key, flight, result=None):
+    flight.result = result
+    with _inflight_lock:
+        _inflight.pop(key, None)
+    flight.done.set()
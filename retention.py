@@ -0,0 +1,328 @@
+import argparse
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import zipfile
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: 同じプロセス内の直列化だけになる
+    fcntl = None
+
+import db
+from db import connect
+from result_cache import prune as prune_result_cache
+
+# ==========================================
+# 🧹 保持期間・アーカイブ・DB の圧縮 (メンテナンス)
+# ==========================================
+# RETENTION_POLICIES を上から順に当てはめ (最初に一致したものを使う)、保持日数を
+# 過ぎたレコードの画像を月別の ZIP (ARCHIVE_DIR/room_ai_YYYY-MM_NNN.zip) へ移す。
+# ZIP は書き足さず、一時ファイルに書いて fsync してから新しい番号の名前で置くので、
+# 途中で落ちても既にあるアーカイブは壊れない。実行はロックファイルで1つずつにする。
+# DB からは画像だけを消し、history の行 (設定・評価) は残すので、管理画面の一覧や
+# 評価の分析はそのまま使える。空いたページは incremental_vacuum でファイルから切り詰める。
+# 実行: python -m retention --dry-run   (何件・何 MB 減るかの確認のみ)
+#       python -m retention             (アーカイブ → 古い計測データの削除 → 圧縮)
+#       python -m retention --keep retried_low=90   (既定で無期限のポリシーを有効にする)
+# 環境変数 ROOM_AI_MAINTENANCE_HOURS があれば、アプリ内でもその間隔で実行する
+# (アプリ内では auto_vacuum を切り替える VACUUM はしない。初回は python -m retention で行う)
+RETENTION_POLICIES = [
+    # (キー, 表示名, 条件 (history の列), 保持日数。None は無期限)
+    ("unrated", "未評価 (閲覧のみ)", "rating = 0", 30),
+    # 評価済みは既定では残す。低評価の再作成分も消したいときだけ --keep retried_low=90 などで指定する
+    ("retried_low", "低評価で再作成", "rating BETWEEN 1 AND 2 AND action = '再作成'", None),
+    ("rated", "評価済み", "rating > 0", None),
+]
+ARCHIVE_DIR = "archive"
+LOCK_FILE = ".retention.lock"
+ARCHIVE_BATCH = 100
+VACUUM_STEP_PAGES = 2000
+METRICS_KEEP_DAYS = 90
+MAINTENANCE_HOURS = os.environ.get("ROOM_AI_MAINTENANCE_HOURS")
+
+logger = logging.getLogger(__name__)
+
+
+def _candidates(conn, now, policies, limit=None):
+    # 保持期限を過ぎ、まだアーカイブしていないレコード [(ポリシーのキー, log)]
+    out, earlier = [], []
+    for key, _, cond, days in policies:
+        if days is not None:
+            sql = f"SELECT {db.HISTORY_COLS} FROM history WHERE ({cond}) AND timestamp < ? AND archive IS NULL"
+            sql += "".join(f" AND NOT ({e})" for e in earlier)
+            sql += " ORDER BY timestamp"
+            params = [now - days * 86400]
+            if limit is not None:
+                sql += " LIMIT ?"
+                params.append(limit - len(out))
+            out += [(key, db.row_to_log(r)) for r in conn.execute(sql, params).fetchall()]
+            if limit is not None and len(out) >= limit:
+                break
+        earlier.append(cond)
+    return out
+
+
+def _record_hashes(conn, log):
+    # レコードが参照している画像 (原寸 + 縮小版)
+    hashes = [h for h in (log["base_hash"], log["gen_hash"]) if h]
+    hashes += [h for (h,) in conn.execute("SELECT hash FROM renditions WHERE record_id = ?", (log["id"],))]
+    return hashes
+
+
+def _db_space(conn):
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    pages = conn.execute("PRAGMA page_count").fetchone()[0]
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return {"file_bytes": pages * page_size, "free_bytes": free * page_size}
+
+
+def plan(now=None, policies=RETENTION_POLICIES):
+    # 実行した場合の見積もり (DB は変更しない)。archive_bytes は同じ画像を1回と数えた原寸の合計、
+    # reclaim_bytes は残るレコードと共有していない画像 (縮小版を含む) の合計
+    now = now or time.time()
+    report = {"policies": {key: {"name": name, "days": days, "records": 0, "archive_bytes": 0}
+                           for key, name, _, days in policies},
+              "reclaim_bytes": 0, "metrics_rows": 0}
+    refs = Counter()
+    with connect() as conn:
+        for key, log in _candidates(conn, now, policies):
+            p = report["policies"][key]
+            p["records"] += 1
+            for h in (log["base_hash"], log["gen_hash"]):
+                if h and h not in refs:
+                    p["archive_bytes"] += conn.execute("SELECT size FROM blobs WHERE hash = ?", (h,)).fetchone()[0]
+            refs.update(_record_hashes(conn, log))
+        hashes = list(refs)
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i + 500]
+            rows = conn.execute(f"SELECT hash, size, refcount FROM blobs WHERE hash IN ({', '.join('?' * len(chunk))})", chunk)
+            report["reclaim_bytes"] += sum(size for h, size, refcount in rows if refcount <= refs[h])
+        cutoff = int(now - METRICS_KEEP_DAYS * 86400)
+        report["metrics_rows"] = sum(conn.execute(f"SELECT COUNT(*) FROM {t} WHERE minute < ?", (cutoff,)).fetchone()[0]
+                                     for t in ("stage_metrics", "stage_totals"))
+        report.update(_db_space(conn))
+    return report
+
+
+_run_lock_local = threading.Lock()
+
+
+@contextmanager
+def _run_lock(archive_dir):
+    # アプリ内の定期実行と CLI が同時に同じアーカイブ・DB を触らないよう、ロックファイルで待ち合わせる。
+    # flock はプロセスが落ちれば外れるので、ロックが残って止まることはない
+    os.makedirs(archive_dir, exist_ok=True)
+    with _run_lock_local, open(os.path.join(archive_dir, LOCK_FILE), "a") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def _archive_month(ts):
+    return f"{datetime.fromtimestamp(ts):%Y-%m}"
+
+
+def _next_archive_path(archive_dir, month):
+    # room_ai_YYYY-MM_NNN.zip の次の番号 (ロック中に呼ぶので他の実行と重ならない)
+    prefix = f"room_ai_{month}_"
+    numbers = [int(name[len(prefix):-4]) for name in os.listdir(archive_dir)
+               if name.startswith(prefix) and name.endswith(".zip") and name[len(prefix):-4].isdigit()]
+    return os.path.join(archive_dir, f"{prefix}{max(numbers, default=0) + 1:03d}.zip")
+
+
+def _fsync_dir(path):
+    # 名前の置き換えをディスクに残す (Windows では開けないので省く)
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_archive(archive_dir, month, conn, logs):
+    # 画像は保存済みの JPEG をハッシュ名 (images/<hash>.jpg) で一度だけ格納し、レコードの内容は
+    # meta/<id>.json に書く (同じベース画像から作った生成結果が多いため)。
+    # 一時ファイルに書き終えて fsync してから名前を付けるので、出来上がった ZIP は書き換えない
+    fd, tmp = tempfile.mkstemp(prefix=".room_ai_", suffix=".tmp", dir=archive_dir)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            with zipfile.ZipFile(f, "w", compression=zipfile.ZIP_STORED) as zf:
+                names = set()
+                for log in logs:
+                    for h in (log["base_hash"], log["gen_hash"]):
+                        if h and f"images/{h}.jpg" not in names:
+                            zf.writestr(f"images/{h}.jpg", conn.execute("SELECT data FROM blobs WHERE hash = ?", (h,)).fetchone()[0])
+                            names.add(f"images/{h}.jpg")
+                    zf.writestr(f"meta/{log['id']}.json", json.dumps(log, ensure_ascii=False), compress_type=zipfile.ZIP_DEFLATED)
+            f.flush()
+            os.fsync(f.fileno())
+        path = _next_archive_path(archive_dir, month)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    _fsync_dir(archive_dir)
+    return path
+
+
+def _remove_stale_temp(archive_dir):
+    # 前回の実行が途中で落ちたときの書きかけ (DB からは何も外していない)
+    for name in os.listdir(archive_dir):
+        if name.startswith(".room_ai_") and name.endswith(".tmp"):
+            os.unlink(os.path.join(archive_dir, name))
+
+
+def archive_expired(now=None, policies=RETENTION_POLICIES, archive_dir=None):
+    # 期限切れレコードの画像を月別 ZIP に移し、DB から外す。アーカイブしたレコード数を返す。
+    # run_maintenance から _run_lock の中で呼ぶ
+    now = now or time.time()
+    archive_dir = archive_dir or ARCHIVE_DIR
+    os.makedirs(archive_dir, exist_ok=True)
+    _remove_stale_temp(archive_dir)
+    conds = {key: cond for key, _, cond, _ in policies}
+    total = 0
+    while True:
+        with connect() as conn:
+            batch = _candidates(conn, now, policies, limit=ARCHIVE_BATCH)
+            by_month = {}
+            for key, log in batch:
+                by_month.setdefault(_archive_month(log["timestamp"]), []).append((key, log))
+            # ZIP への書き込み (fsync 済み) が終わってから DB の画像を外す
+            by_path = {_write_archive(archive_dir, month, conn, [log for _, log in items]): items
+                       for month, items in by_month.items()}
+        if not batch:
+            return total
+        with connect(write=True) as conn:
+            for path, items in by_path.items():
+                for key, log in items:
+                    # 対象を選んだ後に評価された場合は外さない (画像は ZIP に残るだけ)
+                    cur = conn.execute(f"""UPDATE history SET base_hash = NULL, gen_hash = NULL, archive = ?, updated_at = ?
+                                           WHERE id = ? AND archive IS NULL AND ({conds[key]})""",
+                                       (os.path.basename(path), db.change_time(conn), log["id"]))
+                    if cur.rowcount:
+                        conn.execute("DELETE FROM renditions WHERE record_id = ?", (log["id"],))
+                        total += 1
+        if len(batch) < ARCHIVE_BATCH:
+            return total
+
+
+def prune_metrics(now=None):
+    # 1分単位の処理時間の記録は METRICS_KEEP_DAYS 日で削除する
+    cutoff = int((now or time.time()) - METRICS_KEEP_DAYS * 86400)
+    with connect(write=True) as conn:
+        return sum(conn.execute(f"DELETE FROM {t} WHERE minute < ?", (cutoff,)).rowcount for t in ("stage_metrics", "stage_totals"))
+
+
+def compact(convert=False):
+    # 空きページをファイルから切り詰める。auto_vacuum が INCREMENTAL でない既存の DB は
+    # convert のときだけ一度 VACUUM で切り替える (DB の大きさに比例して時間がかかり、その間は
+    # 書き込みをすべて待たせるので、アプリ内の定期実行からは行わず CLI からだけ行う)
+    with connect() as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            if not convert:
+                logger.warning("DB の圧縮には auto_vacuum の切り替えが必要です。python -m retention を一度実行してください")
+                return _db_space(conn)
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        # 書き込みロックを長く握らないよう VACUUM_STEP_PAGES ずつ解放する。
+        # sqlite3 の execute() では1ページしか進まないので executescript() で最後まで実行する
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        while free:
+            conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})")
+            free, prev = conn.execute("PRAGMA freelist_count").fetchone()[0], free
+            if free >= prev:
+                break
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        return _db_space(conn)
+
+
+def run_maintenance(now=None, policies=RETENTION_POLICIES, archive_dir=None, convert=False):
+    archive_dir = archive_dir or ARCHIVE_DIR
+    with _run_lock(archive_dir):
+        before = plan(now, policies)
+        archived = archive_expired(now, policies, archive_dir)
+        pruned = prune_metrics(now)
+        cache_entries = prune_result_cache(now)
+        after = compact(convert)
+    return {"archived": archived, "metrics_rows": pruned, "cache_entries": cache_entries, "before": before, "after": after}
+
+
+_background = None
+_background_lock = threading.Lock()
+
+
+def start_background(hours=MAINTENANCE_HOURS):
+    # hours が指定されていれば、その間隔でメンテナンスを行うスレッドを一度だけ起動する
+    global _background
+    if not hours:
+        return
+    with _background_lock:
+        if _background is not None:
+            return
+        _background = threading.Thread(target=_background_loop, args=(float(hours) * 3600,),
+                                       name="db-maintenance", daemon=True)
+        _background.start()
+
+
+def _background_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            run_maintenance()
+        except Exception:
+            logger.exception("メンテナンスに失敗しました (次の間隔で再実行)")
+
+
+def _mb(n):
+    return f"{n / 1024 / 1024:.1f} MB"
+
+
+def print_report(report):
+    for p in report["policies"].values():
+        keep = "無期限" if p["days"] is None else f"{p['days']} 日"
+        print(f"{p['name']:<14} 保持 {keep:<6} 対象 {p['records']:>6} 件  アーカイブ {_mb(p['archive_bytes']):>10}")
+    print(f"DB から削除される画像 {_mb(report['reclaim_bytes'])}  (他のレコードと共有している画像は残る)")
+    print(f"古い計測データ {report['metrics_rows']} 行")
+    print(f"DB ファイル {_mb(report['file_bytes'])}  うち空き {_mb(report['free_bytes'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="保持期間を過ぎた画像のアーカイブと DB の圧縮")
+    parser.add_argument("--dry-run", action="store_true", help="見積もりだけを表示し、何も変更しない")
+    parser.add_argument("--keep", action="append", default=[], metavar="KEY=DAYS",
+                        help="保持日数を上書き (例: unrated=14)。キー: " + ", ".join(k for k, *_ in RETENTION_POLICIES))
+    parser.add_argument("--archive-dir", default=ARCHIVE_DIR)
+    parser.add_argument("--db", default=db.DB_FILE)
+    args = parser.parse_args()
+
+    overrides = {}
+    for item in args.keep:
+        key, _, days = item.partition("=")
+        if key not in {k for k, *_ in RETENTION_POLICIES} or not days.isdigit():
+            parser.error(f"--keep の指定が不正です: {item}")
+        overrides[key] = int(days)
+    policies = [(k, name, cond, overrides.get(k, days)) for k, name, cond, days in RETENTION_POLICIES]
+
+    db.DB_FILE = args.db
+    db.init_db()
+    if args.dry_run:
+        print_report(plan(policies=policies))
+        return
+    result = run_maintenance(policies=policies, archive_dir=args.archive_dir, convert=True)
+    print_report(result["before"])
+    print(f"\nアーカイブ {result['archived']} 件 → {args.archive_dir}/  計測データ削除 {result['metrics_rows']} 行"
+          f"  生成キャッシュ削除 {result['cache_entries']} 件")
+    print(f"DB ファイル {_mb(result['before']['file_bytes'])} → {_mb(result['after']['file_bytes'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+from PIL import Image
+import io
+import numpy as np
+
+from cache import LRUCache
+from db import blob_hash
+from imaging import pil_to_jpeg
+from preprocess import prepare_image, TEXTURE_MAX_SIDE, INPUT_JPEG_QUALITY
+
+# ==========================================
+# 🧵 独自画像 (張地・フレームの素材写真) の処理
+# ==========================================
+# アップロード時に一度だけ、素材写真から
+#   tile:    素材の代表的な部分を切り出した正方形 (Gemini へはこれだけを送る)
+#   palette: 主な色 [(#rrggbb, 割合)] (選択欄の表示・簡易プレビューの色)
+#   swatch:  表示用の小さな見本
+# を作る。素材写真には机や背景が写り込みやすいので、写真の縁より中央に多い色が最も多く
+# 占める位置を切り出す。結果は元画像のハッシュでキャッシュし、全セッションで使い回す。
+TILE_SIDE = 384
+SWATCH_SIDE = 96
+PALETTE_SIZE = 5
+PALETTE_MIN_SHARE = 0.03  # これより少ない色はパレットに出さない
+TILE_FRACTION = 0.6  # 切り出す正方形の一辺 (短辺に対する割合)
+LABEL_SIDE = 128  # 切り出し位置を決めるときの縮小サイズ
+
+_textures = LRUCache(32 * 1024 * 1024, sizeof=lambda t: len(t["tile"]) + len(t["swatch"]))
+
+
+def _tile_box(img):
+    # 3×3 の候補位置から、素材の色が最も多く占める正方形を選ぶ。同点なら中央
+    small = img.copy()
+    small.thumbnail((LABEL_SIDE, LABEL_SIDE))
+    labels = np.asarray(small.quantize(PALETTE_SIZE, method=Image.Quantize.MEDIANCUT))
+    h, w = labels.shape
+    # 素材の色: 中央に多く、縁 (机・背景が写りやすい) より中央で多い色
+    center = labels[h // 4:h - h // 4, w // 4:w - w // 4]
+    by, bx = max(1, h // 8), max(1, w // 8)
+    border = np.concatenate([labels[:by].ravel(), labels[-by:].ravel(), labels[:, :bx].ravel(), labels[:, -bx:].ravel()])
+    center_share = np.bincount(center.ravel(), minlength=256)[:PALETTE_SIZE] / center.size
+    border_share = np.bincount(border, minlength=256)[:PALETTE_SIZE] / border.size
+    material = (center_share >= 0.1) & (center_share > border_share)
+    if not material.any():
+        material = center_share == center_share.max()
+    material = np.isin(labels, np.nonzero(material)[0])
+
+    # 1×1 や極端に細長い画像では短辺が 1px になるので、一辺は 1px 以上にする
+    side = max(1, int(min(h, w) * TILE_FRACTION))
+    best, best_score = (0.5, 0.5), -1.0
+    for fy, fx in [(0.5, 0.5)] + [(fy, fx) for fy in (0, 0.5, 1) for fx in (0, 0.5, 1)]:
+        y, x = int((h - side) * fy), int((w - side) * fx)
+        score = material[y:y + side, x:x + side].mean()
+        if score > best_score:
+            best, best_score = (fy, fx), score
+    # 縮小版の座標を拡大すると縦横の丸めがずれるので、元画像の短辺から一辺を決め直し、同じ位置に置く
+    fy, fx = best
+    full = max(1, int(min(img.size) * TILE_FRACTION))
+    x, y = int((img.width - full) * fx), int((img.height - full) * fy)
+    return (x, y, x + full, y + full)
+
+
+def _palette(img):
+    small = img.copy()
+    small.thumbnail((LABEL_SIDE, LABEL_SIDE))
+    q = small.quantize(PALETTE_SIZE, method=Image.Quantize.MEDIANCUT)
+    pal = q.getpalette()
+    total = small.width * small.height
+    out = []
+    for count, i in sorted(q.getcolors(), reverse=True):
+        if count / total >= PALETTE_MIN_SHARE:
+            r, g, b = pal[i * 3:i * 3 + 3]
+            out.append((f"#{r:02x}{g:02x}{b:02x}", round(count / total, 3)))
+    return out
+
+
+def process_texture(data):
+    # アップロードされた素材写真 (バイト列) → {"hash", "tile", "palette", "swatch"}
+    h = blob_hash(data)
+    cached = _textures.get(h)
+    if cached is not None:
+        return cached
+
+    img = Image.open(io.BytesIO(prepare_image(data, TEXTURE_MAX_SIDE))).convert("RGB")
+    tile = img.crop(_tile_box(img))
+    if tile.width > TILE_SIDE:
+        tile = tile.resize((TILE_SIDE, TILE_SIDE), Image.Resampling.LANCZOS)
+    swatch = tile.resize((SWATCH_SIDE, SWATCH_SIDE), Image.Resampling.LANCZOS)
+    return _textures.put(h, {
+        "hash": h,
+        "tile": pil_to_jpeg(tile, quality=INPUT_JPEG_QUALITY),
+        "palette": _palette(tile),
+        "swatch": pil_to_jpeg(swatch, quality=80),
+    })